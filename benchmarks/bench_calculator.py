@@ -0,0 +1,39 @@
+'''Compares the compiled calculator engine with the old eval-the-text path.
+
+To use, run: python benchmarks/bench_calculator.py [repeats]'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from calculator import compile_expression, compile_normalized, evaluate
+
+
+# Only expressions the old character check accepted
+EXPRESSIONS = ['2+3*4', '(1.5+2.5)*(3-1)/4', '2**8 + 100/7', '-(3+4)*(5-6)/7+8*9-10']
+
+
+def clear_caches():
+    compile_expression.cache_clear()
+    compile_normalized.cache_clear()
+
+
+def old_eval(expression):
+    # What calculator_command used to do for every message
+    expression = ''.join(expression.split())
+    if not all(char.isdigit() or char in '+-*/.() ' for char in expression):
+        raise ValueError(expression)
+    return eval(expression, {'__builtins__': None}, {})
+
+
+def main(repeats):
+    for expression in EXPRESSIONS:
+        old = timeit.timeit(lambda: old_eval(expression), number=repeats) / repeats
+        cold = timeit.timeit(lambda: (clear_caches(), evaluate(expression)), number=repeats) / repeats
+        cached = timeit.timeit(lambda: evaluate(expression), number=repeats) / repeats
+        print(f'{expression:<24} eval: {old * 1e6:6.2f} us   compiled (cold): {cold * 1e6:6.2f} us   '
+              f'compiled (cached): {cached * 1e6:6.2f} us')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
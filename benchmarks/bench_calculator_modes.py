@@ -0,0 +1,47 @@
+'''Measures /calculator throughput in float, exact and decimal mode.
+
+Typical expressions run inline. Adversarial ones either grow big numbers, which
+sends them to a worker process, or are refused by the size estimate, which
+should cost about as much as a typical expression.
+
+To use, run: python benchmarks/bench_calculator_modes.py [seconds per expression]'''
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from calculator import CalculatorError, calculate
+
+
+MODES = {'float': '', 'exact': 'exact ', 'prec=50': 'prec=50 ', 'prec=1000': 'prec=1000 '}
+
+TYPICAL = ['0.1+0.2', '(1.5+2.5)*(3-1)/4', '1/3+1/6+1/7', '2^64 % 1000', '2^0.5']
+ADVERSARIAL = ['(1/3)^100000', '99999!', '9^9^9', '(10^7)!']
+
+
+async def throughput(text, seconds):
+    '''Returns (calculations per second, outcome of the last one).'''
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        try:
+            outcome = 'ok'
+            await calculate(text)
+        except (CalculatorError, ArithmeticError, ValueError) as e:
+            outcome = str(e)
+        count += 1
+    return count / (time.perf_counter() - start), outcome
+
+
+async def main(seconds):
+    for kind, expressions in (('typical', TYPICAL), ('adversarial', ADVERSARIAL)):
+        print(f'{kind} expressions')
+        for expression in expressions:
+            for mode, prefix in MODES.items():
+                rate, outcome = await throughput(prefix + expression, seconds)
+                print(f'  {expression:<20} {mode:<10} {rate:12.1f}/s   {outcome[:60]}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.5))
@@ -0,0 +1,63 @@
+'''Builds a large memory-mapped fact corpus and measures random fact lookups.
+
+Private (anonymous) resident memory is printed before and after the lookups to show
+that it doesn't grow with the size of the corpus. Pages of the corpus that were read
+show up as file-backed memory, which the OS can drop at any time.
+To use, run: python benchmarks/bench_fact_corpus.py [facts] [lookups]'''
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from facts import FactStore, build_corpus
+
+
+def resident_mb():
+    '''Returns (private, file-backed) resident memory of this process in MB, None outside Linux.'''
+    try:
+        with open('/proc/self/status') as status:
+            fields = dict(line.split(':', 1) for line in status)
+        return int(fields['RssAnon'].split()[0]) / 1024, int(fields['RssFile'].split()[0]) / 1024
+    except (OSError, KeyError):
+        return None
+
+
+def synthetic_facts(count):
+    for i in range(count):
+        yield f'Fact number {i}: the {i % 97}th animal in the list can hold its breath for {i % 60} minutes'
+
+
+def main(count, lookups):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.corpus')
+        start = time.perf_counter()
+        build_corpus(synthetic_facts(count), path)
+        build_time = time.perf_counter() - start
+        print(f'built {count:,} facts in {build_time:.1f}s, {os.path.getsize(path) / 2**20:,.0f} MB on disk')
+
+        before = resident_mb()
+        store = FactStore(path)
+        start = time.perf_counter()
+        store.reload()
+        print(f'opened in {(time.perf_counter() - start) * 1000:.2f} ms')
+
+        indexes = [random.randrange(count) for _ in range(lookups)]
+        start = time.perf_counter()
+        for index in indexes:
+            store[index]
+        elapsed = time.perf_counter() - start
+        print(f'{lookups:,} random lookups: {elapsed / lookups * 1e6:.2f} us per fact')
+
+        after = resident_mb()
+        if before is not None:
+            print(f'private memory: {before[0]:.0f} MB before opening, {after[0]:.0f} MB after the lookups')
+            print(f'file-backed memory: {before[1]:.0f} MB before opening, {after[1]:.0f} MB after the lookups')
+        store.facts.close()
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    main(count, lookups)
@@ -0,0 +1,54 @@
+'''Measures the BM25 fact search: index build time, memory per fact and query latency.
+
+Uses synthetic facts made from a Zipf-like vocabulary so common words have long
+posting lists, like real text.
+To use, run: python benchmarks/bench_fact_search.py [facts] [queries]'''
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from facts import SearchIndex
+
+
+def synthetic_facts(count, vocabulary=20000, seed=1):
+    rng = random.Random(seed)
+    words = [f'word{i}' for i in range(vocabulary)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary)]
+    return [' '.join(rng.choices(words, weights, k=rng.randint(6, 16))) for _ in range(count)], words, weights
+
+
+def main(count, queries):
+    facts, words, weights = synthetic_facts(count)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = SearchIndex.build(facts)
+    build_time = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'built index of {count:,} facts in {build_time:.2f}s, {memory / count:.0f} bytes per fact')
+
+    rng = random.Random(2)
+    samples = [' '.join(rng.choices(words, weights, k=rng.randint(1, 4))) for _ in range(queries)]
+    latencies = []
+    for query in samples:
+        start = time.perf_counter()
+        index.search(query)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print(f'{queries:,} queries: median {latencies[len(latencies) // 2] * 1000:.3f} ms, '
+          f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.3f} ms, max {latencies[-1] * 1000:.3f} ms')
+
+    start = time.perf_counter()
+    for fact in facts[:1000]:
+        index.add(fact)
+    print(f'incremental add: {(time.perf_counter() - start) * 1000:.3f} ms per 1,000 facts')
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 2_000
+    main(count, queries)
@@ -0,0 +1,94 @@
+'''Measures sustained /tasks and /done throughput against the SQLite task store.
+
+Compares committing every change as it happens with the write-behind queue in
+tasks.py, which commits whatever has queued up in one transaction. Each round
+adds a task to a random chat and completes one in another, like a busy bot.
+The last run sends the same changes as multi-line /tasks and ranged /done
+commands of ten tasks each.
+
+To use, run: python benchmarks/bench_task_store.py [changes]'''
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tasks import DELETE_TASK, INSERT_TASK, TaskStore, connect
+
+
+CHATS = 1000
+
+
+def workload(changes):
+    rng = random.Random(1)
+    return [(rng.randrange(CHATS), rng.random() < 0.5) for _ in range(changes)]
+
+
+def commit_each(path, operations):
+    '''The same changes, one transaction per change, without the in-memory lists.'''
+    connection = connect(path)
+    positions = {}
+    for chat_id, done in operations:
+        chat = positions.setdefault(chat_id, [])
+        if done and chat:
+            with connection:
+                connection.execute(DELETE_TASK, (chat_id, chat.pop(0)))
+        else:
+            position = chat[-1] + 1 if chat else 1
+            chat.append(position)
+            with connection:
+                connection.execute(INSERT_TASK, (chat_id, position, 'benchmark task', time.time()))
+    connection.close()
+
+
+def write_behind(path, operations):
+    store = TaskStore(max_tasks=10 ** 9)
+    store.open(path)
+    for chat_id, done in operations:
+        if done and store.complete(chat_id, 1):
+            continue
+        store.add(chat_id, 'benchmark task')
+    queued = time.perf_counter()
+    store.writer.flush()
+    commits = store.writer.commits
+    store.close()
+    return queued, commits
+
+
+def write_behind_bulk(path, operations, size=10):
+    store = TaskStore(max_tasks=10 ** 9)
+    store.open(path)
+    for start in range(0, len(operations), size):
+        chat_id, done = operations[start]
+        oldest = store.tasks(chat_id)[:size]
+        if done and oldest:
+            store.complete_many(chat_id, [(oldest[0].position, oldest[-1].position)])
+            continue
+        store.add_many(chat_id, ['benchmark task'] * size)
+    queued = time.perf_counter()
+    store.writer.flush()
+    commits = store.writer.commits
+    store.close()
+    return queued, commits
+
+
+def main(changes):
+    operations = workload(changes)
+    print(f'{changes} changes over {CHATS} chats')
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        commit_each(os.path.join(directory, 'each.sqlite3'), operations)
+        elapsed = time.perf_counter() - start
+        print(f'{"commit per change":<20} {changes / elapsed:10.0f} changes/s')
+
+        for label, run in (('write-behind', write_behind), ('write-behind, bulk', write_behind_bulk)):
+            start = time.perf_counter()
+            queued, commits = run(os.path.join(directory, f'{run.__name__}.sqlite3'), operations)
+            elapsed = time.perf_counter() - start
+            print(f'{label:<20} {changes / elapsed:10.0f} changes/s   '
+                  f'{changes / (queued - start):10.0f} changes/s seen by commands   {commits} commits')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,90 @@
+'''Measures unit conversion latency over every pair of known unit names.
+
+Compares the precomputed table in units.py with searching the definition graph
+for a path on every request, which is what the table replaces. Also times a
+full /convert through the calculator.
+
+To use, run: python benchmarks/bench_units.py [conversions]'''
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import deque
+from fractions import Fraction
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from calculator import calculate
+from units import unit_table
+
+
+def definition_graph():
+    '''Edges unit -> [(neighbour, scale, offset)] in both directions, straight from the definitions.'''
+    graph = {unit: [] for unit in unit_table.definitions}
+    for unit, definition in unit_table.definitions.items():
+        if definition.startswith('['):
+            continue
+        factor, reference, *offset = definition.split()
+        offset = float(Fraction(offset[1])) * (-1 if offset[0] == '-' else 1) if offset else 0.0
+        reference, scale = unit_table.lookup(reference), float(Fraction(factor))
+        graph[unit].append((reference, scale, offset))
+        graph[reference].append((unit, 1 / scale, -offset / scale))
+    return graph
+
+
+def search_convert(graph, value, source, target):
+    '''Breadth-first search for a path, applying each edge along the way.'''
+    source, target = unit_table.lookup(source), unit_table.lookup(target)
+    queue = deque([(source, value)])
+    seen = {source}
+    while queue:
+        unit, converted = queue.popleft()
+        if unit == target:
+            return converted
+        for neighbour, scale, offset in graph[unit]:
+            if neighbour not in seen:
+                seen.add(neighbour)
+                queue.append((neighbour, converted * scale + offset))
+    raise ValueError(f'No path from {source} to {target}')
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+async def main(conversions):
+    names = {name: unit_table.dimension(name) for name in unit_table.names}
+    by_dimension = {}
+    for name, dimension in names.items():
+        by_dimension.setdefault(dimension, []).append(name)
+    pairs = []
+    rng = random.Random(1)
+    dimensions = list(by_dimension)
+    for _ in range(conversions):
+        candidates = by_dimension[rng.choice(dimensions)]
+        pairs.append((rng.choice(candidates), rng.choice(candidates)))
+    print(f'{len(unit_table)} units, {len(names)} names, {len(dimensions)} dimensions, {conversions} random conversions')
+
+    graph = definition_graph()
+    for label, convert in (('precomputed table', lambda a, b: unit_table.convert(1.5, a, b)),
+                           ('graph search', lambda a, b: search_convert(graph, 1.5, a, b))):
+        samples = []
+        for source, target in pairs:
+            start = time.perf_counter()
+            convert(source, target)
+            samples.append(time.perf_counter() - start)
+        median, p99 = percentiles(samples)
+        print(f'{label:<20} median {median * 1e6:7.2f} us   p99 {p99 * 1e6:7.2f} us')
+
+    samples = []
+    for source, target in pairs[:2000]:
+        start = time.perf_counter()
+        await calculate(f'1.5 {source} in {target}')
+        samples.append(time.perf_counter() - start)
+    median, p99 = percentiles(samples)
+    print(f'{"/convert":<20} median {median * 1e6:7.2f} us   p99 {p99 * 1e6:7.2f} us')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -0,0 +1,73 @@
+'''Compares a fresh ClientSession per request against the shared pooled session.
+
+Runs a local stub of the OpenWeatherMap endpoint so no API key or network is needed.
+To use, run: python benchmarks/bench_weather_session.py [requests] [concurrency]'''
+import asyncio
+import os
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from weather import HttpSessionManager, fetch_weather
+
+
+STUB_REPLY = {'weather': [{'description': 'clear sky'}], 'main': {'temp': 21.5}}
+
+
+async def stub_handler(request):
+    return web.json_response(STUB_REPLY)
+
+
+async def start_stub_server():
+    app = web.Application()
+    app.router.add_get('/data/2.5/weather', stub_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/data/2.5/weather'
+
+
+async def run(label, total, concurrency, make_request):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            status, _ = await make_request({'q': f'city{i % 50}', 'units': 'metric'})
+            assert status == 200
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    print(f'{label:<8} {total} requests in {elapsed:.2f}s -> {total / elapsed:,.0f} req/s')
+
+
+async def main(total, concurrency):
+    runner, url = await start_stub_server()
+    try:
+        async def cold(params):
+            # What get_weather used to do: new connector and handshake every call
+            async with aiohttp.ClientSession() as session:
+                return await fetch_weather(session, params, url=url)
+
+        manager = HttpSessionManager(limit=concurrency, limit_per_host=concurrency)
+        await manager.start()
+
+        async def pooled(params):
+            return await fetch_weather(await manager.get(), params, url=url)
+
+        await run('cold', total, concurrency, cold)
+        await run('pooled', total, concurrency, pooled)
+        await manager.close()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    asyncio.run(main(total, concurrency))
@@ -0,0 +1,895 @@
+'''Expression engine used by the /calculator command.
+
+Expressions are parsed once into a Python AST, checked against a whitelist of
+node types, and compiled to a code object. Compiled expressions are cached by
+their normalized text, so repeated expressions skip parsing entirely.
+
+Before anything runs, the size of every intermediate result is estimated from
+the tree. Small expressions are evaluated right away, big ones in a separate
+process with a time and memory limit, and absurd ones (9^9^9^9) are refused.
+
+Besides plain floats there are three modes, picked by a prefix:
+    exact 0.1+0.2      rational arithmetic with fractions.Fraction, gives 3/10
+    prec=50 1/7        decimal arithmetic rounded to 50 significant digits
+    table x^2+3x for x in 0..10 step 0.5
+                       evaluates the expression over a range, as one NumPy array
+                       operation when NumPy is installed and row by row otherwise
+
+Every chat has its own variables, set with "a = 3.5". ans holds the last result.
+Compiled expressions don't depend on the values, so changing a variable only
+changes the dict the code object is evaluated against.
+
+Numbers can carry units when the expression ends in "in <unit>", like
+"5 mi + 3 km in m" or "70 F in C". Every unit is replaced by its exact factor
+to the target unit, taken from the precomputed table in units.py.'''
+import ast
+import asyncio
+import copy
+import csv
+import decimal
+import io
+import keyword
+import math
+import multiprocessing
+import os
+import re
+import time
+from collections import OrderedDict, namedtuple
+from fractions import Fraction
+from functools import lru_cache
+
+from units import unit_table, UnitError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Tables are evaluated row by row instead
+
+
+CACHE_SIZE = int(os.getenv('CALCULATOR_CACHE_SIZE', 1024))
+MAX_EXPRESSION_LENGTH = 200
+# Every ! is expanded by rescanning the expression, so their number is capped too
+MAX_FACTORIALS = 10
+
+# Cost limits, in bits of the largest number the expression produces
+INLINE_BITS = int(os.getenv('CALCULATOR_INLINE_BITS', 100_000))
+MAX_BITS = int(os.getenv('CALCULATOR_MAX_BITS', 50_000_000))
+# Limits of the worker processes used for expensive expressions
+WORKER_TIMEOUT = float(os.getenv('CALCULATOR_WORKER_TIMEOUT', 5))
+WORKER_MEMORY = int(os.getenv('CALCULATOR_WORKER_MEMORY_MB', 256)) * 2**20
+MAX_WORKERS = int(os.getenv('CALCULATOR_MAX_WORKERS', 2))
+# Python refuses to turn longer integers into text, bigger results are shown rounded
+MAX_DIGITS = 4000
+# Most significant digits a prec=N calculation may ask for. Powers and roots get slow
+# at high precision, so calculations above INLINE_PRECISION run in a worker process.
+MAX_PRECISION = int(os.getenv('CALCULATOR_MAX_PRECISION', 1000))
+INLINE_PRECISION = 100
+# Tables with more rows than TABLE_INLINE_ROWS are summarized and sent as a CSV file
+MAX_TABLE_ROWS = int(os.getenv('CALCULATOR_MAX_TABLE_ROWS', 100_000))
+TABLE_INLINE_ROWS = 20
+# Variables: at most MAX_VARIABLES per chat, and chats that haven't calculated
+# anything for VARIABLES_IDLE_TIMEOUT seconds, or the least recently used ones
+# beyond MAX_VARIABLE_SCOPES, lose theirs
+MAX_VARIABLES = int(os.getenv('CALCULATOR_MAX_VARIABLES', 32))
+MAX_VARIABLE_SCOPES = int(os.getenv('CALCULATOR_MAX_VARIABLE_SCOPES', 10_000))
+# Largest value a variable (or ans) keeps, in bits: 1024 bits is about 300 digits,
+# so all the scopes together stay within tens of MB
+MAX_VARIABLE_BITS = int(os.getenv('CALCULATOR_MAX_VARIABLE_BITS', 1024))
+VARIABLES_IDLE_TIMEOUT = int(os.getenv('CALCULATOR_VARIABLES_IDLE_TIMEOUT', 24 * 3600))
+
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Call, ast.Name, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow,
+    ast.UAdd, ast.USub,
+)
+
+
+class CalculatorError(ValueError):
+    '''Raised for expressions the calculator refuses to evaluate.'''
+
+
+def _whole_number(n):
+    '''n as an int, for floats, fractions and decimals that hold a whole number of 0 or more.'''
+    if not isinstance(n, int):
+        try:
+            if n == int(n):
+                n = int(n)
+        except (OverflowError, ValueError, decimal.InvalidOperation):
+            pass
+    if not isinstance(n, int) or n < 0:
+        raise CalculatorError('Factorials are only defined for whole numbers of 0 or more.')
+    return n
+
+
+def factorial(n):
+    return math.factorial(_whole_number(n))
+
+
+def decimal_factorial(n):
+    # Multiplying in the decimal context keeps every step at the chosen precision,
+    # turning math.factorial's exact result into a Decimal takes quadratic time
+    result = decimal.Decimal(1)
+    for i in range(2, _whole_number(n) + 1):
+        result *= i
+    return result
+
+
+FUNCTIONS = {'factorial': factorial}
+
+# Nothing from the outside world is reachable while an expression runs.
+# In exact and decimal mode every number literal is wrapped in a call to _number.
+NAMESPACES = {
+    'float': {'__builtins__': {}, **FUNCTIONS},
+    'exact': {'__builtins__': {}, **FUNCTIONS, '_number': Fraction},
+    'decimal': {'__builtins__': {}, **FUNCTIONS, 'factorial': decimal_factorial, '_number': decimal.Decimal},
+}
+
+# names are the variables the expression reads, tree is kept to estimate the
+# cost again once their values are known
+CompiledExpression = namedtuple('CompiledExpression', 'text mode code bits names tree')
+
+MODE_PREFIX = re.compile(r'\s*(?:(exact)|prec\s*=\s*(\d+))\s+', re.IGNORECASE)
+
+
+def parse_mode(text: str):
+    '''Splits an optional "exact" or "prec=N" prefix off an expression.
+    Returns (mode, precision, expression), precision is only set in decimal mode.'''
+    match = MODE_PREFIX.match(text)
+    if not match:
+        return 'float', None, text
+    if match.group(1):
+        return 'exact', None, text[match.end():]
+    precision = int(match.group(2))
+    if not 1 <= precision <= MAX_PRECISION:
+        raise CalculatorError(f'The precision has to be between 1 and {MAX_PRECISION} digits.')
+    return 'decimal', precision, text[match.end():]
+
+
+def _expand_factorials(expression: str):
+    '''Rewrites postfix factorials, 5!, x! and (2+3)!, as calls to factorial().'''
+    while '!' in expression:
+        end = expression.index('!')
+        start = end
+        if start and expression[start - 1] == ')':
+            depth = 0
+            while start:
+                start -= 1
+                depth += {')': 1, '(': -1}.get(expression[start], 0)
+                if not depth:
+                    break
+            # A call like factorial(7)! takes the function name along
+            while start and (expression[start - 1].isalnum() or expression[start - 1] == '_'):
+                start -= 1
+        else:
+            while start and (expression[start - 1].isalnum() or expression[start - 1] in '._'):
+                start -= 1
+        if start == end:
+            raise CalculatorError('A ! has to follow a number, a name or a bracket.')
+        expression = f'{expression[:start]}factorial({expression[start:end]}){expression[end + 1:]}'
+    return expression
+
+
+def normalize(expression: str):
+    '''Rewrites an expression to the form it is compiled and cached under.'''
+    # Checked on the text as typed: the rewrites below take time that grows with its length
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise CalculatorError(f'Expressions can be at most {MAX_EXPRESSION_LENGTH} characters long.')
+    if expression.count('!') > MAX_FACTORIALS:
+        raise CalculatorError(f'Expressions can use ! at most {MAX_FACTORIALS} times.')
+    expression = expression.replace('^', '**').replace('×', '*').replace('÷', '/')
+    # Spaces around operators don't matter, but "2 3" must stay an error
+    expression = re.sub(r'\s*([^\w.\s])\s*', r'\1', expression.strip())
+    # Implicit multiplication: 2(3+4), (1+2)(3+4), (1+2)3, (1+2)x, 3x and 5 km, but not 2e5
+    expression = re.sub(r'(?<=[\d.)])(?=\()|(?<=\))(?=[\w.])', '*', expression)
+    expression = re.sub(r'(?<![\w.])((?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(?=[^\W\d_])(?![eE][-+]?\d)', r'\1*', expression)
+    return _expand_factorials(expression)
+
+
+def check(tree):
+    '''Makes sure the tree only uses numbers, arithmetic, the calculator's functions and variables.
+    Returns the names of the variables it reads.'''
+    functions = {id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)}
+    names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise CalculatorError('Please use only numbers and the operators + - * / % ^ ! ( ).')
+        if isinstance(node, ast.Constant) and (type(node.value) not in (int, float)):
+            raise CalculatorError('Please use only numbers and the operators + - * / % ^ ! ( ).')
+        if isinstance(node, ast.Name):
+            if id(node) in functions:
+                if node.id not in FUNCTIONS:
+                    raise CalculatorError(f'Unknown function: {node.id}')
+            elif node.id in FUNCTIONS or node.id.startswith('_'):
+                raise CalculatorError(f'{node.id} can\'t be used as a variable.')
+            else:
+                names.add(node.id)
+        if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or len(node.args) != 1 or node.keywords):
+            raise CalculatorError('Functions take exactly one argument.')
+    return frozenset(names)
+
+
+def estimate_bits(node, mode='float', bindings=None):
+    '''Estimates how big the numbers computed for node get, without computing them.
+
+    Returns (bits, is_float, peak): an upper bound on log2 of the result's size, whether
+    it is a float, and the largest bound of any intermediate result, which is what
+    evaluating it costs. Floats can't grow past 1024 bits, they overflow.
+
+    In exact mode the size of a fraction is that of its numerator and denominator
+    together. Decimals never hold more digits than the precision, so in decimal mode
+    only factorials, which take a multiplication per step, count towards the cost.
+    Table mode works with floats throughout.
+
+    Variables are estimated from their values in bindings. Without bindings they
+    are assumed to be floats.'''
+    if isinstance(node, ast.Expression):
+        return estimate_bits(node.body, mode, bindings)
+    if isinstance(node, ast.Constant):
+        return _value_bits(node.value, mode)
+    if isinstance(node, ast.Name):
+        if bindings is None or mode == 'table':
+            return 1024, True, 0
+        return _value_bits(bindings[node.id], mode)
+    if isinstance(node, ast.UnaryOp):
+        return estimate_bits(node.operand, mode, bindings)
+    if isinstance(node, ast.Call):
+        bits, is_float, peak = estimate_bits(node.args[0], mode, bindings)
+        if mode == 'table':
+            return 1024, True, peak  # Tables use the gamma function, a float
+        # n! has about n * log2(n) bits
+        n = _constant(node.args[0], _power_of_two(bits))
+        result = n * math.log2(n) if n > 2 else 2
+        return result, False, max(peak, result)
+
+    left, left_float, left_peak = estimate_bits(node.left, mode, bindings)
+    right, right_float, right_peak = estimate_bits(node.right, mode, bindings)
+    peak = max(left_peak, right_peak)
+    is_float = left_float or right_float
+    if isinstance(node.op, ast.Pow):
+        exponent = _constant(node.right, _power_of_two(right))
+        if left_float or right_float or (mode == 'float' and _is_negative(node.right)):
+            result = 1024
+            is_float = True
+        elif left == 0:
+            result = 0  # 0, 1 and -1 stay small whatever the exponent
+        else:
+            result = left * exponent
+    elif is_float or (mode == 'float' and isinstance(node.op, ast.Div)):
+        result, is_float = 1024, True
+    elif mode == 'exact' and not isinstance(node.op, ast.Mult):
+        # a/b + c/d = (ad + bc) / bd
+        result = left + right + 1
+    elif isinstance(node.op, (ast.Mult, ast.Div)):
+        result = left + right
+    elif isinstance(node.op, ast.Mod):
+        result = min(left, right)
+    else:
+        result = max(left, right) + 1
+    if mode == 'decimal':
+        return result, is_float, peak
+    return result, is_float, max(peak, result)
+
+
+def _value_bits(value, mode):
+    '''estimate_bits for a single number, as it will be once converted for mode.'''
+    if mode == 'exact':
+        value = to_mode(value, 'exact')
+        return _log2(value.numerator) + _log2(value.denominator), False, 0
+    if mode == 'decimal':
+        # Dividing by a small number makes a big one
+        return abs(_signed_log2(value)), False, 0
+    if not isinstance(value, int):
+        return 1024, True, 0
+    return _log2(value), False, 0
+
+
+def _log2(n):
+    return math.log2(abs(n)) if abs(n) > 1 else 0
+
+
+def _signed_log2(value):
+    '''log2 of a number's magnitude, without overflowing for huge fractions and decimals.'''
+    if not value:
+        return 0
+    if isinstance(value, Fraction):
+        return math.log2(abs(value.numerator)) - math.log2(value.denominator)
+    if isinstance(value, decimal.Decimal):
+        if not value.is_finite():
+            return math.inf
+        return (value.adjusted() + 1) * math.log2(10)
+    return math.log2(abs(value))
+
+
+def to_mode(value, mode):
+    '''Converts a variable's value to the number type mode calculates with.
+    Decimals have to be converted inside the decimal context.'''
+    if mode == 'exact':
+        if isinstance(value, float):
+            return Fraction(repr(value))  # 0.1 is 1/10, like the literal
+        return Fraction(value)
+    if mode == 'decimal':
+        if isinstance(value, Fraction):
+            return decimal.Decimal(value.numerator) / value.denominator
+        return decimal.Decimal(repr(value) if isinstance(value, float) else value)
+    if isinstance(value, (Fraction, decimal.Decimal)):
+        return float(value)
+    return value
+
+
+def _power_of_two(bits):
+    '''2 ** bits as a float, capped instead of overflowing.'''
+    return 2.0 ** min(bits, 1023)
+
+
+def _constant(node, default):
+    '''Exact value of a constant operand, or default for anything computed.'''
+    if isinstance(node, ast.Constant):
+        return abs(node.value)
+    return default
+
+
+def _is_negative(node):
+    return isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub)
+
+
+class _WrapNumbers(ast.NodeTransformer):
+    '''Turns every number literal into _number("literal"), so 0.1 becomes exactly 1/10.'''
+
+    def visit_Constant(self, node):
+        call = ast.Call(func=ast.Name(id='_number', ctx=ast.Load()), args=[ast.Constant(repr(node.value))], keywords=[])
+        return ast.copy_location(call, node)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_normalized(expression: str, mode='float'):
+    if not expression:
+        raise CalculatorError('Please type an expression to calculate.')
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise CalculatorError(f'Expressions can be at most {MAX_EXPRESSION_LENGTH} characters long.')
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError:
+        raise CalculatorError('That doesn\'t look like a valid expression.') from None
+    names = check(tree)
+    _, _, peak = estimate_bits(tree, mode)
+    code_tree = tree
+    if mode in ('exact', 'decimal'):
+        code_tree = ast.fix_missing_locations(_WrapNumbers().visit(copy.deepcopy(tree)))
+    code = compile(code_tree, '<calculator>', 'eval')
+    return CompiledExpression(expression, mode, code, peak, names, tree if names else None)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_expression(expression: str, mode='float'):
+    '''Returns the compiled expression, from the cache when possible.
+    The text as typed is cached too, so a repeated expression isn't even normalized again.'''
+    return compile_normalized(normalize(expression), mode)
+
+
+def bind(compiled, variables):
+    '''Picks the variables compiled reads out of a chat's variables.'''
+    if not compiled.names:
+        return {}
+    missing = compiled.names.difference(variables)
+    if missing:
+        raise CalculatorError(f'Unknown name: {min(missing)}. Set it first, like /calculator {min(missing)} = 2')
+    return {name: variables[name] for name in compiled.names}
+
+
+def cost(compiled, bindings):
+    '''The size of the biggest number evaluating compiled produces, in bits.'''
+    if not compiled.names:
+        return compiled.bits
+    return estimate_bits(compiled.tree, compiled.mode, bindings)[2]
+
+
+def run(compiled, precision=None, bindings=None):
+    if compiled.mode == 'decimal':
+        return _run_decimal(compiled, precision, bindings)
+    local = {name: to_mode(value, compiled.mode) for name, value in bindings.items()} if bindings else {}
+    try:
+        result = eval(compiled.code, NAMESPACES[compiled.mode], local)
+    except ZeroDivisionError:
+        raise ZeroDivisionError('division by zero') from None  # Fractions say "Fraction(1, 0)"
+    if compiled.mode == 'exact' and isinstance(result, float):
+        raise CalculatorError('That result isn\'t a fraction, so it can\'t be exact. Try prec=50 instead.')
+    return result
+
+
+def _run_decimal(compiled, precision, bindings):
+    try:
+        # Only the digits cost memory, the exponent can be as large as decimal allows
+        with decimal.localcontext(prec=precision, Emax=decimal.MAX_EMAX, Emin=decimal.MIN_EMIN):
+            local = {name: to_mode(value, 'decimal') for name, value in bindings.items()} if bindings else {}
+            # The unary plus rounds a plain number like "prec=3 3.14159" to the precision
+            return +eval(compiled.code, NAMESPACES['decimal'], local)
+    except decimal.DivisionByZero:
+        raise ZeroDivisionError('division by zero') from None
+    except decimal.Overflow:
+        raise CalculatorError('That number is too big for me to calculate.') from None
+    except decimal.InvalidOperation:
+        raise CalculatorError('That calculation has no defined result.') from None
+
+
+def evaluate(expression: str, mode='float', precision=None, variables=None):
+    '''Evaluates an arithmetic expression like "2^10 + (3 - 1) % 2" in this process.
+    Refuses expressions that would produce numbers above MAX_BITS.'''
+    compiled = compile_expression(expression, mode)
+    bindings = bind(compiled, variables or {})
+    if cost(compiled, bindings) > MAX_BITS:
+        raise CalculatorError('That number is too big for me to calculate.')
+    return run(compiled, precision, bindings)
+
+
+def format_result(result):
+    '''Turns a result into text, huge integers and fractions are rounded to scientific notation.'''
+    if isinstance(result, Fraction):
+        if result.denominator == 1:
+            return format_result(result.numerator)
+        if result.numerator.bit_length() + result.denominator.bit_length() > MAX_DIGITS * 3.32:
+            return _rounded(math.log10(abs(result.numerator)) - math.log10(result.denominator), result < 0)
+        try:
+            return f'{result} (≈ {float(result):.12g})'
+        except OverflowError:
+            return str(result)
+    if isinstance(result, int) and result.bit_length() > MAX_DIGITS * 3.32:
+        exponent = math.log10(abs(result))
+        return f'{_rounded(exponent, result < 0)} ({int(exponent) + 1} digits)'
+    return str(result)
+
+
+def _rounded(exponent, negative):
+    whole = math.floor(exponent)
+    return f'≈ {"-" if negative else ""}{10 ** (exponent - whole):.6f}e{whole:+d}'
+
+
+def _worker(expression, mode, precision, bindings, keep_value, connection, memory_limit):
+    '''Runs in a child process: evaluates one expression under a memory limit and sends
+    back ("ok", text, value) or ("error", message, None). value is None unless keep_value.'''
+    try:
+        import resource
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        with open('/proc/self/statm') as statm:
+            in_use = int(statm.read().split()[0]) * page_size
+        resource.setrlimit(resource.RLIMIT_AS, (in_use + memory_limit, in_use + memory_limit))
+    except (ImportError, OSError, ValueError, AttributeError):
+        pass  # No memory limit on this platform, the time limit still applies
+    try:
+        value = run(compile_normalized(expression, mode), precision, bindings)
+        connection.send(('ok', format_result(value), value if keep_value else None))
+    except CalculatorError as e:
+        connection.send(('error', str(e), None))
+    except MemoryError:
+        connection.send(('error', 'That calculation needs too much memory.', None))
+    except (ArithmeticError, ValueError) as e:
+        connection.send(('error', f'Error: {e}', None))
+    finally:
+        connection.close()
+
+
+_worker_slots = None
+
+
+async def _evaluate_in_worker(compiled, precision, bindings, keep_value):
+    '''Returns (text, value) of an expression evaluated in a worker process.'''
+    global _worker_slots
+    if _worker_slots is None:
+        _worker_slots = asyncio.Semaphore(MAX_WORKERS)
+    loop = asyncio.get_running_loop()
+    async with _worker_slots:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_worker, args=(compiled.text, compiled.mode, precision, bindings, keep_value, sender, WORKER_MEMORY), daemon=True)
+        await loop.run_in_executor(None, process.start)
+        sender.close()
+        try:
+            finished = await loop.run_in_executor(None, receiver.poll, WORKER_TIMEOUT)
+            if not finished:
+                raise CalculatorError(f'That calculation took longer than {WORKER_TIMEOUT:g} seconds, so I stopped it.')
+            try:
+                status, text, value = receiver.recv()
+            except EOFError:
+                raise CalculatorError('That calculation needs too much memory.') from None
+        finally:
+            receiver.close()
+            process.kill()
+            await loop.run_in_executor(None, process.join)
+    if status == 'error':
+        raise CalculatorError(text)
+    return text, value
+
+
+ASSIGNMENT = re.compile(r'\s*([A-Za-z]\w*)\s*=(?!=)\s*(.*)', re.DOTALL)
+RESERVED = {'exact', 'prec', 'table', *FUNCTIONS}
+
+
+def parse_assignment(expression: str):
+    '''Splits "a = 3.5" into ("a", "3.5"). Returns (None, expression) for anything else.'''
+    match = ASSIGNMENT.match(expression)
+    if not match:
+        return None, expression
+    name, expression = match.groups()
+    if name in RESERVED or keyword.iskeyword(name):
+        raise CalculatorError(f'{name} can\'t be used as a variable.')
+    return name, expression
+
+
+CONVERSION = re.compile(r'(?P<expression>.+?)\s+(?:in|to)\s+(?P<target>\S+)\s*$', re.DOTALL)
+TRAILING_UNIT = re.compile(r'(?P<value>.*[\d.)\s])(?P<unit>[^\W\d_][\w°²³/-]*|°[\w°]*)\s*$', re.DOTALL)
+UNIT_NAME = re.compile(r'(?<![\w.])[^\W\d_][\w°²³]*|°[\w°]*')
+
+
+def parse_conversion(expression: str):
+    '''Splits "5 mi in km" into ("5 mi", "km"). Returns (expression, None) if it doesn't end in a unit.'''
+    match = CONVERSION.match(expression)
+    if not match:
+        return expression, None
+    # The calculator has no other use for "in" or "to", so the target has to be a unit
+    if unit_table.lookup(match.group('target')) is None:
+        raise CalculatorError(f'I don\'t know the unit {match.group("target")}.')
+    return match.group('expression'), match.group('target')
+
+
+def with_units(expression: str, target: str, variables):
+    '''Rewrites an expression carrying units into a normalized one that computes the result in target.
+    "5 mi + 3 km" becomes "5*(25146/15625)+3*(1)" for kilometres. Units with an offset, like
+    temperatures, and compound ones, like km/h, only work as the last thing in the expression.'''
+    def is_unit(name):
+        return name not in variables and name not in FUNCTIONS and unit_table.lookup(name) is not None
+
+    try:
+        match = TRAILING_UNIT.match(expression)
+        unit = match and match.group('unit')
+        if unit and unit not in variables and unit_table.lookup(unit) is not None:
+            scale, offset = unit_table.factor(unit, target)
+            if offset or not UNIT_NAME.fullmatch(unit):
+                # The unit applies to everything in front of it, which must not carry units itself
+                value = normalize(match.group('value'))
+                if any(is_unit(name) for name in UNIT_NAME.findall(value)):
+                    raise CalculatorError(f'{unit} can only be converted on its own, like 70 F in C.')
+                return f'({value})*({scale})+({offset})'
+
+        def replace(match, placeholder=None):
+            name = match.group(0)
+            if not is_unit(name):
+                if placeholder and name not in variables and name not in FUNCTIONS:
+                    raise CalculatorError(f'I don\'t know the unit {name}.')
+                return name
+            scale, offset = unit_table.factor(name, target)
+            if offset:
+                raise CalculatorError(f'{name} can only be converted on its own, like 70 F in C.')
+            # Normalizing already put a * between 5 and km, but not between 5 and °
+            before = match.string[match.start() - 1:match.start()]
+            return f'*({placeholder or scale})' if before and before in '0123456789.)' else f'({placeholder or scale})'
+        normalized = normalize(expression)
+        _check_units(UNIT_NAME.sub(lambda match: replace(match, UNIT_PLACEHOLDER), normalized))
+        return UNIT_NAME.sub(replace, normalized)
+    except UnitError as e:
+        raise CalculatorError(str(e)) from None
+
+
+UNIT_PLACEHOLDER = '_unit'
+MISSING_UNIT = 'Every number needs a unit when converting, like 5 km + 200 m in m.'
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _check_units(expression: str):
+    '''Refuses units that are multiplied, divided or raised by each other, like 6 m / 2 m,
+    and numbers without a unit, like the 2 in 5 km + 2: every unit is replaced by one
+    scale factor, so those would come out silently wrong.
+    expression has UNIT_PLACEHOLDER in place of every unit.'''
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError:
+        return  # Compiling reports it
+
+    def has_unit(node):
+        if isinstance(node, ast.Name):
+            return node.id == UNIT_PLACEHOLDER
+        if isinstance(node, ast.UnaryOp):
+            return has_unit(node.operand)
+        if isinstance(node, ast.BinOp):
+            left, right = has_unit(node.left), has_unit(node.right)
+            if isinstance(node.op, (ast.Add, ast.Sub)):
+                if left != right:
+                    raise CalculatorError(MISSING_UNIT)
+                return left
+            # A number times a unit, or a unit divided by a number, is a quantity
+            if isinstance(node.op, ast.Mult) and not (left and right) or isinstance(node.op, ast.Div) and not right:
+                return left or right
+            if left or right:
+                raise CalculatorError('Units can only be added, subtracted, and multiplied or divided by numbers. '
+                                      'Write compound units like km/h last, like 10 m/s in km/h.')
+            return False
+        if any(has_unit(child) for child in ast.iter_child_nodes(node)):
+            raise CalculatorError('Units can\'t be used inside functions, convert the result instead.')
+        return False
+
+    if not has_unit(tree.body):
+        raise CalculatorError(MISSING_UNIT)
+
+
+def stored_bits(value):
+    '''Returns about how many bits storing a number takes.'''
+    if isinstance(value, int):
+        return value.bit_length()
+    if isinstance(value, Fraction):
+        return value.numerator.bit_length() + value.denominator.bit_length()
+    if isinstance(value, decimal.Decimal):
+        return math.ceil(len(value.as_tuple().digits) * math.log2(10))
+    return 64
+
+
+class VariableScopes:
+    '''Calculator variables of every chat, keyed by chat id.
+
+    A chat's variables are a plain dict of name -> number that compiled expressions
+    are evaluated against. Chats idle for longer than idle_timeout lose them, and so
+    do the least recently used ones once there are more than max_scopes.'''
+
+    def __init__(self, max_scopes=MAX_VARIABLE_SCOPES, idle_timeout=VARIABLES_IDLE_TIMEOUT, clock=time.monotonic):
+        self.max_scopes = max_scopes
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self._scopes = OrderedDict()  # chat id -> (last used, variables), least recently used first
+
+    def __len__(self):
+        return len(self._scopes)
+
+    def get(self, chat_id):
+        '''Returns the variables of a chat, an empty dict for a new or evicted one.'''
+        now = self.clock()
+        entry = self._scopes.pop(chat_id, None)
+        variables = entry[1] if entry is not None and entry[0] > now - self.idle_timeout else {}
+        self._scopes[chat_id] = (now, variables)
+        self.evict(now)
+        return variables
+
+    def evict(self, now=None):
+        '''Drops idle and surplus scopes, oldest first. Returns how many were dropped.'''
+        now = self.clock() if now is None else now
+        dropped = 0
+        while self._scopes:
+            last_used, _ = next(iter(self._scopes.values()))
+            if last_used > now - self.idle_timeout and len(self._scopes) <= self.max_scopes:
+                break
+            self._scopes.popitem(last=False)
+            dropped += 1
+        return dropped
+
+
+variable_scopes = VariableScopes()
+
+
+async def calculate(text: str, variables=None):
+    '''Evaluates an expression, optionally prefixed with "exact" or "prec=N", without
+    blocking the event loop and returns the result as text.
+
+    Cheap expressions run inline. Expensive ones run in a worker process with a hard
+    time limit and a memory cap, at most MAX_WORKERS at a time.
+
+    With a chat's variables, "name = expression" sets a variable and every result
+    of at most MAX_VARIABLE_BITS is stored as ans. An expression ending in "in <unit>" is
+    converted to that unit.'''
+    mode, precision, expression = parse_mode(text)
+    name, expression = parse_assignment(expression)
+    expression, target = parse_conversion(expression)
+    if variables is None:
+        variables = {}
+    if target is None:
+        compiled = compile_expression(expression, mode)
+    else:
+        compiled = compile_normalized(with_units(expression, target, variables), mode)
+    bindings = bind(compiled, variables)
+    bits = cost(compiled, bindings)
+    if bits > MAX_BITS:
+        raise CalculatorError('That number is too big for me to calculate.')
+    keep_value = bits <= INLINE_BITS
+    if name is not None:
+        if not keep_value:
+            raise CalculatorError('That number is too big to keep in a variable.')
+        if name not in variables and len(variables) >= MAX_VARIABLES:
+            raise CalculatorError(f'You can have at most {MAX_VARIABLES} variables.')
+    if keep_value and (precision or 0) <= INLINE_PRECISION:
+        value = run(compiled, precision, bindings)
+        result = format_result(value)
+    else:
+        result, value = await _evaluate_in_worker(compiled, precision, bindings, keep_value)
+    if not isinstance(value, (int, float, Fraction, decimal.Decimal)):
+        if name is not None:
+            raise CalculatorError('Only real numbers can be kept in a variable.')
+    elif stored_bits(value) > MAX_VARIABLE_BITS:
+        if name is not None:
+            raise CalculatorError('That number is too big to keep in a variable.')
+        # A stale ans would be more confusing than none
+        variables.pop('ans', None)
+    else:
+        variables['ans'] = value
+        if name is not None:
+            variables[name] = value
+    if target is not None:
+        result = f'{result} {target}'
+    return f'{name} = {result}' if name is not None else result
+
+
+Table = namedtuple('Table', 'expression variable start stop step xs ys')
+
+NUMBER = r'[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?'
+TABLE_PATTERN = re.compile(
+    rf'\s*table\s+(?P<expression>.+?)\s+for\s+(?P<variable>[A-Za-z_]\w*)\s+in\s+'
+    rf'(?P<start>{NUMBER})\s*\.\.\s*(?P<stop>{NUMBER})(?:\s+step\s+(?P<step>{NUMBER}))?\s*$',
+    re.IGNORECASE | re.DOTALL)
+
+
+def is_table(text: str):
+    return text.lstrip()[:6].lower() == 'table '
+
+
+def parse_table(text: str):
+    '''Splits "table x^2+3x for x in 0..10 step 0.5" into (compiled expression, variable, start, stop, step).'''
+    match = TABLE_PATTERN.match(text)
+    if not match:
+        raise CalculatorError('Please write a table as: table x^2+3x for x in 0..10 step 0.5')
+    variable = match.group('variable')
+    if variable in FUNCTIONS:
+        raise CalculatorError(f'{variable} is a function, please pick another variable name.')
+    start, stop = float(match.group('start')), float(match.group('stop'))
+    step = float(match.group('step') or 1)
+    if not step > 0 or not stop >= start:
+        raise CalculatorError('The range has to go up from start to stop, with a step above 0.')
+    if (stop - start) / step + 1 > MAX_TABLE_ROWS:
+        raise CalculatorError(f'Tables can have at most {MAX_TABLE_ROWS} rows.')
+    compiled = compile_expression(match.group('expression'), 'table')
+    if compiled.names - {variable}:
+        raise CalculatorError(f'Unknown name: {min(compiled.names - {variable})}')
+    if compiled.bits > INLINE_BITS:
+        raise CalculatorError('That number is too big for me to calculate.')
+    return compiled, variable, start, stop, step
+
+
+def _float_factorial(n):
+    if not (n >= 0 and float(n).is_integer()):
+        return math.nan
+    try:
+        return math.gamma(n + 1)
+    except OverflowError:
+        return math.inf
+
+
+def _ieee_divide(a, b):
+    try:
+        return a / b
+    except ZeroDivisionError:
+        if a == 0 or math.isnan(a):
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1, b)
+
+
+def _ieee_power(a, b):
+    try:
+        return a ** b
+    except ZeroDivisionError:
+        # 0 to a negative power; -0.0 keeps its sign for odd integer powers
+        return math.copysign(math.inf, a) if float(b).is_integer() and b % 2 else math.inf
+
+
+class _IEEEOperators(ast.NodeTransformer):
+    '''Turns / and ^ into calls that give inf for division by zero, like NumPy does.'''
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        function = {ast.Div: '_ieee_divide', ast.Pow: '_ieee_power'}.get(type(node.op))
+        if function is None:
+            return node
+        call = ast.Call(func=ast.Name(id=function, ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+        return ast.copy_location(call, node)
+
+
+def evaluate_table(text: str):
+    '''Evaluates a table expression for every value of its range and returns a Table.'''
+    compiled, variable, start, stop, step = parse_table(text)
+    rows = int((stop - start) / step + 1e-9) + 1
+    if np is not None:
+        # One array operation per node of the expression instead of a Python loop per row
+        xs = start + np.arange(rows) * step
+        namespace = {'__builtins__': {}, 'factorial': np.vectorize(_float_factorial, otypes=[float]), variable: xs}
+        with np.errstate(all='ignore'):
+            ys = eval(compiled.code, namespace, {})
+        if np.iscomplexobj(ys):
+            # Only constants like (-1)^0.5 are complex, NumPy gives nan for (-1)^x itself
+            ys = np.where(np.imag(ys) == 0, np.real(ys), math.nan)
+        ys = np.broadcast_to(np.asarray(ys, dtype=float), xs.shape)
+    else:
+        xs = [start + i * step for i in range(rows)]
+        namespace = {'__builtins__': {}, 'factorial': _float_factorial,
+                     '_ieee_divide': _ieee_divide, '_ieee_power': _ieee_power}
+        ieee_code = None
+        ys = []
+        for x in xs:
+            namespace[variable] = x
+            try:
+                try:
+                    y = eval(compiled.code, namespace, {})
+                except ZeroDivisionError:
+                    # Rows like 1/x at 0 are evaluated again with NumPy's inf instead of an error
+                    if ieee_code is None:
+                        tree = ast.fix_missing_locations(_IEEEOperators().visit(copy.deepcopy(compiled.tree)))
+                        ieee_code = compile(tree, '<calculator>', 'eval')
+                    y = eval(ieee_code, namespace, {})
+                ys.append(float(y) if not isinstance(y, complex) else math.nan)
+            except OverflowError:
+                ys.append(math.inf)
+            except (ArithmeticError, ValueError):
+                ys.append(math.nan)
+    return Table(compiled.text, variable, start, stop, step, xs, ys)
+
+
+def _number(value):
+    return f'{value:.10g}'
+
+
+def summarize_table(table):
+    '''Returns the table as text: every row of a short table, or the minimum, maximum,
+    mean and first and last rows of a long one.'''
+    x, rows = table.variable, len(table.xs)
+    lines = [f'f({x}) = {table.expression} for {x} from {_number(table.start)} to {_number(table.stop)} '
+             f'step {_number(table.step)}, {rows} rows']
+    if rows > TABLE_INLINE_ROWS:
+        finite, low, high, mean = _table_stats(table)
+        if finite:
+            lines.append(f'min {_number(table.ys[low])} at {x}={_number(table.xs[low])}, '
+                         f'max {_number(table.ys[high])} at {x}={_number(table.xs[high])}, mean {_number(mean)}')
+        if finite < rows:
+            lines.append(f'{rows - finite} rows are undefined or infinite')
+        shown = list(range(5)) + [None] + list(range(rows - 5, rows))
+    else:
+        shown = range(rows)
+    lines.append('')
+    for i in shown:
+        lines.append('...' if i is None else f'{x}={_number(table.xs[i])}: {_number(table.ys[i])}')
+    return '\n'.join(lines)
+
+
+def _table_stats(table):
+    '''Returns (number of finite rows, row of the minimum, row of the maximum, mean), ignoring nan and inf.'''
+    if np is not None:
+        finite = np.isfinite(table.ys)
+        count = int(finite.sum())
+        if not count:
+            return 0, None, None, None
+        ys = table.ys[finite]
+        rows = np.flatnonzero(finite)
+        # Dividing first keeps the sum from overflowing when the rows are near the float maximum
+        return count, rows[ys.argmin()], rows[ys.argmax()], (ys / count).sum()
+    rows = [i for i, y in enumerate(table.ys) if math.isfinite(y)]
+    if not rows:
+        return 0, None, None, None
+    key = table.ys.__getitem__
+    # Dividing first keeps the sum from overflowing when the rows are near the float maximum
+    return len(rows), min(rows, key=key), max(rows, key=key), math.fsum(key(i) / len(rows) for i in rows)
+
+
+def table_csv(table):
+    '''Returns the table as CSV, built in memory.'''
+    buffer = io.BytesIO()
+    if np is not None:
+        np.savetxt(buffer, np.column_stack((table.xs, table.ys)), fmt='%.15g', delimiter=',',
+                   header=f'{table.variable},{table.expression}', comments='')
+        return buffer.getvalue()
+    text = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+    writer = csv.writer(text, lineterminator='\n')
+    writer.writerow((table.variable, table.expression))
+    writer.writerows((f'{x:.15g}', f'{y:.15g}') for x, y in zip(table.xs, table.ys))
+    text.flush()
+    return buffer.getvalue()
+
+
+def _table_reply(text):
+    table = evaluate_table(text)
+    document = table_csv(table) if len(table.xs) > TABLE_INLINE_ROWS else None
+    return summarize_table(table), document
+
+
+async def calculate_table(text: str):
+    '''Evaluates a table expression off the event loop.
+    Returns (summary text, CSV bytes), the CSV is None for tables short enough to show in full.'''
+    return await asyncio.get_running_loop().run_in_executor(None, _table_reply, text)
@@ -0,0 +1,171 @@
+'''Offline index of city names and OpenWeatherMap city ids.
+
+The index is a single binary file that is memory-mapped at startup, so looking a
+city up costs a binary search over the file instead of a network round-trip.
+
+File layout (all integers are little-endian uint32):
+    header   b'CIX1', number of entries
+    offsets  entries + 1 offsets into the names blob
+    ids      one city id per entry
+    names    utf-8 encoded normalized names, sorted bytewise
+
+To build it from the OpenWeatherMap city list (http://bulk.openweathermap.org/sample/city.list.json.gz):
+    python cities.py city.list.json.gz cities.idx [aliases.tsv]
+The optional aliases file has one "alias<TAB>city id" pair per line.'''
+import difflib
+import gzip
+import json
+import mmap
+import os
+import struct
+import sys
+from functools import lru_cache
+
+from weather import normalize_city
+
+
+MAGIC = b'CIX1'
+HEADER = struct.Struct('<4sI')
+# Misspelled names whose suggestions are remembered, the index never changes while open
+SUGGEST_CACHE_SIZE = int(os.getenv('CITY_SUGGEST_CACHE_SIZE', 4096))
+
+
+class CityIndex:
+    '''Read-only view of a city index file.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            self._mm = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError(f'{path} is not a city index file')
+        self._offsets = HEADER.size
+        self._ids = self._offsets + 4 * (self.count + 1)
+        self._names = self._ids + 4 * self.count
+        # Per index, so closing it doesn't leave suggestions for another file behind
+        self._suggest = lru_cache(maxsize=SUGGEST_CACHE_SIZE)(self._suggest)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._mm.close()
+
+    def _name(self, i):
+        start, end = struct.unpack_from('<II', self._mm, self._offsets + 4 * i)
+        return self._mm[self._names + start:self._names + end]
+
+    def _id(self, i):
+        return struct.unpack_from('<I', self._mm, self._ids + 4 * i)[0]
+
+    def _lower_bound(self, name):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, city):
+        '''Returns the city id for a name or alias, or None if the city is not in the index.
+        When several cities share a name the first one from the source list wins.'''
+        name = normalize_city(city).encode()
+        i = self._lower_bound(name)
+        if i < self.count and self._name(i) == name:
+            return self._id(i)
+        return None
+
+    def prefix(self, text, limit=10):
+        '''Returns up to limit (name, city id) pairs whose name starts with text.'''
+        text = normalize_city(text).encode()
+        matches = []
+        i = self._lower_bound(text)
+        while i < self.count and len(matches) < limit:
+            name = self._name(i)
+            if not name.startswith(text):
+                break
+            matches.append((name.decode(), self._id(i)))
+            i += 1
+        return matches
+
+    def suggest(self, city, limit=3, cutoff=0.8):
+        '''Returns names close to a misspelled city, used for "did you mean" replies.
+        Only names sharing the first letter are compared, and the answer for each
+        normalized name is cached, since the same typos come back. It still takes
+        milliseconds on a big index, so call it from an executor.'''
+        name = normalize_city(city)
+        if not name:
+            return []
+        return list(self._suggest(name, limit, cutoff))
+
+    def _suggest(self, name, limit, cutoff):
+        head = name[:1].encode()
+        candidates = []
+        i = self._lower_bound(head)
+        while i < self.count:
+            candidate = self._name(i)
+            if not candidate.startswith(head):
+                break
+            # Lengths in characters: in bytes a Cyrillic name is twice as long as typed
+            candidate = candidate.decode()
+            if abs(len(candidate) - len(name)) <= 2:
+                candidates.append(candidate)
+            i += 1
+        return tuple(difflib.get_close_matches(name, list(dict.fromkeys(candidates)), limit, cutoff))
+
+
+def load_city_index(path):
+    '''Opens the city index, returns None if it hasn't been built.'''
+    if not path or not os.path.exists(path):
+        return None
+    return CityIndex(path)
+
+
+def build_city_index(entries, path):
+    '''Writes an index file from an iterable of (name, city id) pairs.'''
+    pairs = {}
+    for name, city_id in entries:
+        key = normalize_city(name).encode()
+        if key:
+            # Remember the first id seen for each name, duplicates keep source order
+            pairs.setdefault(key, city_id)
+    names = sorted(pairs)
+
+    offsets = [0]
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+    with open(path, 'wb') as index_file:
+        index_file.write(HEADER.pack(MAGIC, len(names)))
+        index_file.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        index_file.write(struct.pack(f'<{len(names)}I', *(pairs[name] for name in names)))
+        index_file.write(b''.join(names))
+    return len(names)
+
+
+def read_city_list(path):
+    '''Yields (name, city id) pairs from OpenWeatherMap's city.list.json(.gz).'''
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as city_file:
+        for city in json.load(city_file):
+            yield city['name'], city['id']
+
+
+def read_aliases(path):
+    with open(path, encoding='utf-8') as alias_file:
+        for line in alias_file:
+            if line.strip() and not line.startswith('#'):
+                alias, city_id = line.rstrip('\n').split('\t')
+                yield alias, int(city_id)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        sys.exit('Usage: python cities.py city.list.json[.gz] cities.idx [aliases.tsv]')
+    entries = list(read_city_list(sys.argv[1]))
+    if len(sys.argv) == 4:
+        entries += list(read_aliases(sys.argv[3]))
+    count = build_city_index(entries, sys.argv[2])
+    print(f'Wrote {count} names to {sys.argv[2]}')
@@ -0,0 +1,548 @@
+'''Fact pool used by the /fact command.
+
+Facts come either from a facts.txt style text file, which is loaded into memory,
+or from a prebuilt corpus file, which is memory-mapped so even packs with millions
+of facts don't use more memory than the pages actually read.
+
+Corpus layout (all integers are little-endian):
+    header   b'FCT1', number of facts (uint64)
+    offsets  facts + 1 uint64 offsets where each fact starts in the text blob
+    text     utf-8 encoded facts
+
+To build a corpus from a facts.txt style file (--dedupe drops near-duplicate facts first):
+    python facts.py [--dedupe] facts.txt facts.corpus
+To list the near-duplicate facts of a file:
+    python facts.py facts.txt'''
+import hashlib
+import heapq
+import math
+import mmap
+import os
+import random
+import re
+import struct
+import sys
+import tempfile
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+
+FACTS_FILE = os.getenv('FACTS_FILE', 'facts.txt')
+FACTS_RELOAD_INTERVAL = float(os.getenv('FACTS_RELOAD_INTERVAL', 30))
+# Facts whose keywords overlap at least this much (Jaccard similarity) are treated as one fact
+DEDUP_THRESHOLD = float(os.getenv('FACTS_DEDUP_THRESHOLD', 0.8))
+
+
+def clean_fact(line: str):
+    '''Strips the quotes, trailing comma and whitespace around a line of facts.txt.'''
+    return line.strip().rstrip(',').strip().strip('"').strip()
+
+
+def read_facts(path):
+    with open(path, encoding='utf-8') as fact_file:
+        return tuple(fact for fact in map(clean_fact, fact_file) if fact)
+
+
+CORPUS_MAGIC = b'FCT1'
+CORPUS_HEADER = struct.Struct('<4sQ')
+
+
+class FactCorpus:
+    '''Read-only, memory-mapped fact corpus. Getting a fact is one offset lookup and one slice.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as corpus_file:
+            self._mm = mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = CORPUS_HEADER.unpack_from(self._mm, 0)
+        if magic != CORPUS_MAGIC:
+            self._mm.close()
+            raise ValueError(f'{path} is not a fact corpus')
+        self._offsets = CORPUS_HEADER.size
+        self._text = self._offsets + 8 * (self.count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not -self.count <= index < self.count:
+            raise IndexError('fact index out of range')
+        index %= self.count
+        start, end = struct.unpack_from('<QQ', self._mm, self._offsets + 8 * index)
+        return self._mm[self._text + start:self._text + end].decode('utf-8')
+
+    def close(self):
+        self._mm.close()
+
+
+def is_corpus(path):
+    with open(path, 'rb') as fact_file:
+        return fact_file.read(len(CORPUS_MAGIC)) == CORPUS_MAGIC
+
+
+def build_corpus(facts, path):
+    '''Writes an iterable of facts to a corpus file and returns how many were written.
+
+    The text goes to a temporary file first so only the offsets are kept in memory,
+    and the finished corpus replaces path in one rename.'''
+    offsets = array('Q', [0])
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryFile(dir=directory) as text_file:
+        for fact in facts:
+            text_file.write(fact.encode('utf-8'))
+            offsets.append(text_file.tell())
+        text_file.seek(0)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as corpus_file:
+            corpus_file.write(CORPUS_HEADER.pack(CORPUS_MAGIC, len(offsets) - 1))
+            corpus_file.write(offsets.tobytes())
+            while True:
+                chunk = text_file.read(1 << 20)
+                if not chunk:
+                    break
+                corpus_file.write(chunk)
+    os.replace(corpus_file.name, path)
+    return len(offsets) - 1
+
+
+def iter_facts(path):
+    '''Yields the cleaned facts of a facts.txt style file one at a time.'''
+    with open(path, encoding='utf-8') as fact_file:
+        for line in fact_file:
+            fact = clean_fact(line)
+            if fact:
+                yield fact
+
+
+STOPWORDS = frozenset('''a an and are as at be but by can for from has have in is it its of on or than that the
+their there they this to was were which while with you your'''.split())
+
+# Topics for /fact {topic}, each one matches facts containing any of its keywords
+TOPICS = {
+    'animals': '''animal ant bat bee bird butterfly cat chameleon chicken chimpanzee cow crocodile crow dolphin
+                  dragonfly eagle elephant fish flamingo flea giraffe goat gorilla jellyfish kangaroo koala lobster
+                  mammal mosquito octopus ostrich otter owl penguin pig pigeon rhinoceros raven shark shrimp sloth
+                  slug snail snake spider squirrel tiger turtle whale wombat unicorn'''.split(),
+    'space': '''space universe star sun moon planet galaxy jupiter saturn mars mercury venus earth astronaut
+                solar shuttle alien'''.split(),
+    'body': '''human body bone blood brain heart cell dna skin tongue nose eye muscle saliva stomach hair'''.split(),
+    'food': '''food fruit banana strawberry honey apple avocado carrot tomato orange peanut cheese chocolate
+               milk bread coconut'''.split(),
+    'history': '''history war invented inventor first century pyramid cleopatra ancient'''.split(),
+    'nature': '''nature ocean water tree rainforest lightning cloud snowflake earthquake mountain desert wave
+                 weather'''.split(),
+}
+
+
+def stem(word: str):
+    '''Very small plural stemmer, so "animals" and "animal" are the same keyword.'''
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and word.endswith(('ses', 'xes', 'zes', 'ches', 'shes')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us')):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str):
+    '''Splits text into lower case, stemmed keywords without stopwords.'''
+    text = unicodedata.normalize('NFKD', text).casefold()
+    return [stem(word) for word in re.findall(r'[a-z0-9]+', text) if word not in STOPWORDS and len(word) > 1]
+
+
+def _merge(postings):
+    '''Merges several sorted posting lists into one sorted list without duplicates.'''
+    merged = sorted(set().union(*postings))
+    return array('I', merged)
+
+
+def _contains(posting, value):
+    i = bisect_left(posting, value)
+    return i < len(posting) and posting[i] == value
+
+
+class SearchIndex:
+    '''BM25 full-text index over the facts.
+
+    Each term keeps two parallel arrays: the ids of the facts containing it (array('I'),
+    always sorted because ids only grow) and how often it appears in each (array('H')).
+    Facts can be added one at a time; idf and the average length are worked out at
+    query time, so nothing has to be rebuilt after an add.
+
+    Terms found in more than FULL_SCAN facts also keep a champion list, a heap of their
+    CHAMPIONS best scoring postings. A search scores rare terms in full, but a common
+    term only brings in new facts through its champion list, and is looked up by
+    binary search for the best CANDIDATES facts found so far. That keeps queries fast
+    on big packs at the cost of exactness for queries made only of common words.'''
+
+    K1 = 1.2
+    B = 0.75
+    FULL_SCAN = 256
+    CHAMPIONS = 64
+    CANDIDATES = 128
+
+    def __init__(self):
+        self.postings = {}  # term -> (fact ids, term frequencies)
+        self.champions = {}  # term -> min-heap of (weight, fact id)
+        self.lengths = array('H')
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, facts):
+        index = cls()
+        for i in range(len(facts)):
+            index.add(facts[i])
+        return index
+
+    def copy(self):
+        '''Returns an independent copy that more facts can be added to while this one is searched.
+        Copying the arrays is much cheaper than tokenizing the facts again.'''
+        index = type(self)()
+        index.postings = {term: (array('I', ids), array('H', frequencies)) for term, (ids, frequencies) in self.postings.items()}
+        index.champions = {term: list(champions) for term, champions in self.champions.items()}
+        index.lengths = array('H', self.lengths)
+        index.total_length = self.total_length
+        return index
+
+    def _weight(self, tf, length, average):
+        '''The BM25 score of a term in a fact, without the idf factor.'''
+        return tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * length / average))
+
+    def add(self, fact):
+        '''Indexes one more fact and returns its id, which is its position in the pool.'''
+        fact_id = len(self.lengths)
+        words = tokenize(fact)
+        counts = {}
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+        length = min(len(words), 0xFFFF)
+        self.lengths.append(length)
+        self.total_length += length
+        average = self.total_length / len(self.lengths) or 1.0
+        for word, count in counts.items():
+            tf = min(count, 0xFFFF)
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = (array('I'), array('H'))
+            posting[0].append(fact_id)
+            posting[1].append(tf)
+            champions = self.champions.get(word)
+            if champions is not None:
+                item = (self._weight(tf, length, average), fact_id)
+                if len(champions) < self.CHAMPIONS:
+                    heapq.heappush(champions, item)
+                else:
+                    heapq.heappushpop(champions, item)
+            elif len(posting[0]) > self.FULL_SCAN:
+                # The term just became common, pick its champions once from the full list
+                ids, frequencies = posting
+                weights = ((self._weight(tf, self.lengths[i], average), i) for i, tf in zip(ids, frequencies))
+                champions = heapq.nlargest(self.CHAMPIONS, weights)
+                heapq.heapify(champions)
+                self.champions[word] = champions
+        return fact_id
+
+    def _idf(self, term):
+        df = len(self.postings[term][0])
+        return math.log(1 + (len(self.lengths) - df + 0.5) / (df + 0.5))
+
+    def search(self, query, limit=3):
+        '''Returns up to limit (score, fact id) pairs for the facts that best match the query,
+        best match first.'''
+        terms = sorted({word for word in tokenize(query) if word in self.postings}, key=lambda word: len(self.postings[word][0]))
+        if not terms:
+            return []
+        lengths = self.lengths
+        base = self.K1 * (1 - self.B)
+        scale = self.K1 * self.B * len(lengths) / self.total_length
+        k1_plus_one = self.K1 + 1
+        scores = {}
+        for term in terms:
+            idf = self._idf(term)
+            ids, frequencies = self.postings[term]
+            if term not in self.champions:
+                for fact_id, tf in zip(ids, frequencies):
+                    score = idf * tf * k1_plus_one / (tf + base + scale * lengths[fact_id])
+                    scores[fact_id] = scores.get(fact_id, 0.0) + score
+                continue
+            if len(scores) > self.CANDIDATES:
+                scores = {fact_id: scores[fact_id] for fact_id in heapq.nlargest(self.CANDIDATES, scores, key=scores.get)}
+            found = set()
+            for weight, fact_id in self.champions[term]:
+                found.add(fact_id)
+                scores[fact_id] = scores.get(fact_id, 0.0) + idf * weight
+            for fact_id in scores:
+                if fact_id not in found:
+                    i = bisect_left(ids, fact_id)
+                    if i < len(ids) and ids[i] == fact_id:
+                        tf = frequencies[i]
+                        scores[fact_id] += idf * tf * k1_plus_one / (tf + base + scale * lengths[fact_id])
+        return [(scores[fact_id], fact_id) for fact_id in heapq.nlargest(limit, scores, key=scores.get)]
+
+
+class TopicIndex:
+    '''Inverted index from keywords and topics to the facts that mention them.
+
+    Posting lists are sorted array('I') of fact indexes, about 4 bytes per entry.'''
+
+    def __init__(self, postings):
+        self.postings = postings
+
+    @classmethod
+    def build(cls, facts, topics=TOPICS):
+        return cls.from_search_index(SearchIndex.build(facts), topics)
+
+    @classmethod
+    def from_search_index(cls, search_index, topics=TOPICS):
+        '''Reuses the fact id arrays of a SearchIndex as keyword posting lists.'''
+        lists = {word: ids for word, (ids, _) in search_index.postings.items()}
+        for topic, keywords in topics.items():
+            keywords = {stem(keyword) for keyword in keywords} | {stem(topic)}
+            lists[stem(topic)] = _merge(lists.get(keyword, ()) for keyword in keywords)
+        return cls(lists)
+
+    def lookup(self, terms):
+        '''Returns the posting lists for the query terms, smallest first, or [] if any term matches nothing.'''
+        words = list(dict.fromkeys(word for term in terms for word in tokenize(term)))
+        if not words:
+            return []
+        postings = [self.postings.get(word) for word in words]
+        if not all(postings):
+            return []
+        return sorted(postings, key=len)
+
+    def random_match(self, terms, attempts=32):
+        '''Returns the index of a random fact matching all the terms, or None.
+
+        Candidates are drawn from the shortest posting list and checked against the
+        others with binary search, so the full intersection is never built. If the
+        intersection is so sparse that random draws keep missing, the shortest list
+        is scanned once with reservoir sampling instead.'''
+        postings = self.lookup(terms)
+        if not postings:
+            return None
+        smallest, others = postings[0], postings[1:]
+        for _ in range(attempts):
+            candidate = smallest[random.randrange(len(smallest))]
+            if all(_contains(posting, candidate) for posting in others):
+                return candidate
+        chosen, seen = None, 0
+        for candidate in smallest:
+            if all(_contains(posting, candidate) for posting in others):
+                seen += 1
+                if random.randrange(seen) == 0:
+                    chosen = candidate
+        return chosen
+
+    def topics(self):
+        return sorted(TOPICS)
+
+
+# MinHash settings: 16 hash functions split into 4 bands of 4. Two facts land in the
+# same bucket of at least one band with high probability once their similarity is
+# above about 0.7, and rarely below that.
+MINHASH_SIZE = 16
+MINHASH_BANDS = 4
+MINHASH_WORD = struct.Struct(f'<{MINHASH_SIZE}H')
+
+
+def word_hashes(word: str):
+    '''The 16 independent hash values of a word, cut from one blake2b digest.'''
+    return MINHASH_WORD.unpack(hashlib.blake2b(word.encode(), digest_size=MINHASH_WORD.size).digest())
+
+
+def minhash(words, cache):
+    '''MinHash signature of a set of words. cache maps words to their word_hashes.'''
+    hashes = []
+    for word in words:
+        value = cache.get(word)
+        if value is None:
+            value = cache[word] = word_hashes(word)
+        hashes.append(value)
+    return tuple(map(min, zip(*hashes)))
+
+
+def find_near_duplicates(facts, threshold=DEDUP_THRESHOLD):
+    '''Groups facts that say the same thing, e.g. "Octopuses have three hearts" and
+    "An octopus has three hearts".
+
+    Each fact is reduced to its set of keywords and a MinHash signature. Locality
+    sensitive hashing on the signature bands finds earlier facts it may repeat, and the
+    real keyword overlap of those candidates decides. Every fact is compared with a few
+    bucket leaders only, so the pass is linear in the number of facts.
+    Returns {index of the kept fact: [indexes of its duplicates]}.'''
+    rows = MINHASH_SIZE // MINHASH_BANDS
+    cache = {}
+    buckets = {}
+    kept_words = {}
+    exact = {}
+    clusters = {}
+    for i in range(len(facts)):
+        words = frozenset(tokenize(facts[i]))
+        if not words:
+            # Nothing to compare on, only drop exact repeats
+            original = exact.setdefault(facts[i].casefold(), i)
+            if original != i:
+                clusters.setdefault(original, []).append(i)
+            continue
+        signature = minhash(words, cache)
+        bands = [(band, signature[band * rows:(band + 1) * rows]) for band in range(MINHASH_BANDS)]
+        original = None
+        for band in bands:
+            candidate = buckets.get(band)
+            if candidate is not None:
+                other = kept_words[candidate]
+                if len(words & other) / len(words | other) >= threshold:
+                    original = candidate
+                    break
+        if original is not None:
+            clusters.setdefault(original, []).append(i)
+            continue
+        kept_words[i] = words
+        for band in bands:
+            buckets.setdefault(band, i)
+    return clusters
+
+
+def dedupe_facts(facts, threshold=DEDUP_THRESHOLD):
+    '''Returns the facts without near duplicates, and the clusters that were collapsed
+    as tuples of facts (the kept one first).'''
+    clusters = find_near_duplicates(facts, threshold)
+    dropped = {i for duplicates in clusters.values() for i in duplicates}
+    kept = tuple(fact for i, fact in enumerate(facts) if i not in dropped)
+    return kept, [tuple(facts[i] for i in [original] + duplicates) for original, duplicates in clusters.items()]
+
+
+class FactStore:
+    '''Holds the facts as an immutable tuple, or as a memory-mapped FactCorpus,
+    together with the TopicIndex and SearchIndex built from them.
+
+    The file is read once, and again only when its modification time changes,
+    so /fact never reads the file itself. reload() is slow for big packs and is
+    meant to run in a worker thread; the facts and their index are swapped in
+    together as one snapshot. When facts were only appended to the file, a copy
+    of the old index gets just the new facts added.
+
+    Corpus files get no indexes, which would take memory that grows with the
+    corpus; their snapshot has None for both and they only serve random facts.
+
+    Near-duplicate facts in text files are collapsed on every load, the clusters
+    that were collapsed are kept in duplicates. Corpus files are expected to be
+    deduplicated when they are built.'''
+
+    def __init__(self, path=FACTS_FILE):
+        self.path = path
+        self._snapshot = ((), TopicIndex({}), SearchIndex())
+        self._mtime = None
+        self.duplicates = []
+
+    @property
+    def facts(self):
+        return self._snapshot[0]
+
+    @property
+    def topic_index(self):
+        return self._snapshot[1]
+
+    @property
+    def search_index(self):
+        return self._snapshot[2]
+
+    def snapshot(self):
+        '''Returns (facts, topic index, search index) built from the same version of the file.
+        The indexes are None for a corpus file.'''
+        return self._snapshot
+
+    def __len__(self):
+        return len(self.facts)
+
+    def __getitem__(self, index):
+        return self.facts[index]
+
+    def reload(self):
+        '''Rereads the file if it changed since the last load. Returns True if the facts were reloaded.'''
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return False
+        # An old corpus is not closed here, it is unmapped once the last reader drops it
+        if is_corpus(self.path):
+            self._snapshot = (FactCorpus(self.path), None, None)
+            self.duplicates = []
+            self._mtime = mtime
+            return True
+        facts, duplicates = dedupe_facts(read_facts(self.path))
+        old_facts, _, old_index = self._snapshot
+        if isinstance(old_facts, tuple) and old_index is not None and facts[:len(old_facts)] == old_facts:
+            # Only appended to: the index in use is left alone, the new facts go into a copy
+            search_index = old_index.copy()
+            for fact in facts[len(old_facts):]:
+                search_index.add(fact)
+        else:
+            search_index = SearchIndex.build(facts)
+        self._snapshot = (facts, TopicIndex.from_search_index(search_index), search_index)
+        self.duplicates = duplicates
+        self._mtime = mtime
+        return True
+
+
+fact_store = FactStore()
+
+
+def _mix(value, key):
+    value = ((value ^ key) * 0x45D9F3B) & 0xFFFFFFFF
+    value = ((value ^ (value >> 16)) * 0x45D9F3B) & 0xFFFFFFFF
+    return value ^ (value >> 16)
+
+
+def permute(index, seed, size):
+    '''Maps index to its position in a random permutation of range(size) chosen by seed.
+
+    A small Feistel network shuffles the bits of the index, which is a bijection on
+    range(2 ** bits); values that land outside range(size) are shuffled again until
+    they fall inside (cycle walking), which keeps it a bijection on range(size).'''
+    bits = max(2, (size - 1).bit_length())
+    bits += bits % 2
+    half = bits // 2
+    mask = (1 << half) - 1
+    while True:
+        left, right = index >> half, index & mask
+        for round_number in range(4):
+            left, right = right, left ^ (_mix(right, seed + round_number) & mask)
+        index = (left << half) | right
+        if index < size:
+            return index
+
+
+def next_fact_index(state, size):
+    '''Picks the next fact for a chat so no fact repeats until all of them have been seen.
+
+    state is the chat's (seed, cursor, pool size) tuple, or None for a new chat.
+    Returns the fact index and the new state. A new permutation is started once
+    the chat has seen every fact, or when the pool size changed after a reload.'''
+    if state is None or state[1] >= size or state[2] != size:
+        state = (random.getrandbits(32), 0, size)
+    seed, cursor, _ = state
+    return permute(cursor, seed, size), (seed, cursor + 1, size)
+
+
+if __name__ == '__main__':
+    arguments = [argument for argument in sys.argv[1:] if argument != '--dedupe']
+    if len(arguments) == 1:
+        _, clusters = dedupe_facts(read_facts(arguments[0]))
+        for cluster in clusters:
+            print(' | '.join(cluster))
+        print(f'{len(clusters)} clusters, {sum(len(cluster) - 1 for cluster in clusters)} duplicate facts')
+    elif len(arguments) == 2:
+        facts = iter_facts(arguments[0])
+        if '--dedupe' in sys.argv:
+            facts, clusters = dedupe_facts(tuple(facts))
+            print(f'Dropped {sum(len(cluster) - 1 for cluster in clusters)} duplicate facts')
+        count = build_corpus(facts, arguments[1])
+        print(f'Wrote {count} facts to {arguments[1]}')
+    else:
+        sys.exit('Usage: python facts.py [--dedupe] facts.txt [facts.corpus]')
@@ -1,17 +1,31 @@
 from typing import final
-from telegram import Update
-from telegram.ext import CommandHandler, MessageHandler, Application, filters, ContextTypes, CallbackContext
-import aiohttp,datetime, random, inspect
-import os, re
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, Application, filters, ContextTypes, CallbackContext
+from telegram.ext import PicklePersistence, PersistenceInput
+import datetime, inspect, asyncio
+import os
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Local modules read their settings from the environment, so import them after load_dotenv
+from weather import http_sessions, fetch_weather, fetch_weather_group, weather_cache, weather_flights, normalize_city
+from weather import city_ids, GROUP_MAX_IDS, MAX_CITIES_PER_COMMAND, MULTI_CITY_CONCURRENCY
+from weather import city_popularity, REFRESH_TOP_N, REFRESH_INTERVAL, REFRESH_AHEAD, REFRESH_CALLS_PER_MINUTE
+from weather import weather_breaker, weather_budget, UPSTREAM_ERRORS, RateLimitedError
+from cities import load_city_index
+from facts import fact_store, next_fact_index, FACTS_RELOAD_INTERVAL
+from calculator import calculate, calculate_table, is_table, variable_scopes, CalculatorError
+from tasks import task_store, task_pages, parse_numbers, TaskError, TASKS_DB
+
 
 TOKEN: final= os.getenv('TOKEN')
 BOTUSERNAME: final= os.getenv('BOTUSERNAME')
 API_KEY: final= os.getenv('API_KEY')
+CITY_INDEX: final= os.getenv('CITY_INDEX', 'cities.idx')
+PERSISTENCE_FILE: final= os.getenv('PERSISTENCE_FILE', 'simpomni_bot.pickle')
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ''' This is used to start the bot.'''
@@ -43,24 +57,193 @@ information about a specific function.'''
             await update.message.reply_text(response[i:i+chunk_size])
 
 
+city_index = None # Offline city name -> id index, loaded in post_init if it has been built
+
+def city_id_for(key: str):
+    '''Returns the OpenWeatherMap id of a normalized city name if we know it.'''
+    city_id = city_ids.get(key)
+    if city_id is None and city_index is not None:
+        city_id = city_index.lookup(key)
+    return city_id
+
+async def lookup_weather(city: str):
+    '''Returns the OpenWeatherMap data for a city, or None if the city is unknown.
+    Answers come from weather_cache when possible.'''
+    key = normalize_city(city)
+    # With the city index loaded, unknown cities are rejected without a network call,
+    # and before they count as popular, so the refresh job never looks them up
+    if city_index is not None and city_id_for(key) is None:
+        return None
+    city_popularity.hit(key)
+    data = weather_cache.get(key)
+    if data is not weather_cache.MISS:
+        return data
+    return await _lookup_uncached(key)
+
+async def _lookup_uncached(key: str):
+    '''Fetches a city that was already counted and missed the cache, falling back to stale data.'''
+    # Concurrent requests for the same city share a single upstream call
+    try:
+        return await weather_flights.do(key, lambda: fetch_city_weather(key))
+    except UPSTREAM_ERRORS:
+        # Serve the expired answer if we still have one rather than nothing
+        cached = weather_cache.peek(key)
+        if cached is not None and cached[1] is not None:
+            return cached[1]
+        raise
+
+async def call_weather_api(fetch):
+    '''Sends one request to OpenWeatherMap through the shared rate budget and the circuit breaker.
+    fetch(timeout) does the actual request and returns a (status, data) tuple.'''
+    await weather_budget.acquire()
+    try:
+        return await weather_breaker.call(fetch)
+    except RateLimitedError as e:
+        # A 429 from the API, hold every weather call until it says we can retry
+        weather_budget.penalize(e.retry_after)
+        raise
+
+async def fetch_city_weather(key: str):
+    session = await http_sessions.get()
+    params = {'appid': API_KEY, 'units': 'metric'}
+    city_id = city_id_for(key)
+    if city_id is not None:
+        params['id'] = city_id
+    else:
+        params['q'] = key
+    status, data = await call_weather_api(lambda timeout: fetch_weather(session, params, timeout=timeout))
+    if status == 200 or status == 404:
+        # Only cache real answers, not errors like a rejected API key
+        weather_cache.set(key, data)
+    if data is not None:
+        city_ids[key] = data['id']
+    return data
+
+async def lookup_weather_many(cities: list):
+    '''Looks up several cities at once.
+    Returns a dict of normalized city -> data, None for unknown cities, or the error raised for that city.'''
+    keys = list(dict.fromkeys(normalize_city(city) for city in cities))
+    results = {}
+    for key in keys:
+        if city_index is not None and city_id_for(key) is None:
+            results[key] = None
+            continue
+        city_popularity.hit(key)
+        data = weather_cache.get(key)
+        if data is not weather_cache.MISS:
+            results[key] = data
+
+    semaphore = asyncio.Semaphore(MULTI_CITY_CONCURRENCY)
+    session = await http_sessions.get()
+    params = {'appid': API_KEY, 'units': 'metric'}
+
+    # Cities we already know the id of are fetched together through the group endpoint
+    by_id = {}
+    for key in keys:
+        if key not in results and city_id_for(key) is not None:
+            by_id[city_id_for(key)] = key
+    ids = list(by_id)
+
+    async def fetch_group(chunk):
+        async with semaphore:
+            try:
+                status, found = await call_weather_api(lambda timeout: fetch_weather_group(session, chunk, params, timeout=timeout))
+            except UPSTREAM_ERRORS:
+                return  # These cities are retried one by one below
+        if status == 200:
+            for city_id, data in found.items():
+                if city_id in by_id:
+                    weather_cache.set(by_id[city_id], data)
+                    results[by_id[city_id]] = data
+
+    await asyncio.gather(*(fetch_group(ids[i:i+GROUP_MAX_IDS]) for i in range(0, len(ids), GROUP_MAX_IDS)))
+
+    # Everything else goes out as single lookups, a few at a time
+    async def fetch_one(key):
+        async with semaphore:
+            try:
+                # Counted and checked against the cache above already
+                results[key] = await _lookup_uncached(key)
+            except UPSTREAM_ERRORS as e:
+                results[key] = e
+
+    await asyncio.gather(*(fetch_one(key) for key in keys if key not in results))
+    return results
+
+async def refresh_popular_weather(context: CallbackContext):
+    '''Job that refreshes the most requested cities before their cached weather expires,
+    so popular /weather calls are always answered from the cache.'''
+    # Spread the upstream calls we are willing to spend per minute over the runs
+    budget = max(1, int(REFRESH_CALLS_PER_MINUTE * REFRESH_INTERVAL / 60))
+    if weather_breaker.state == weather_breaker.OPEN:
+        return
+    for key, _ in city_popularity.top(REFRESH_TOP_N):
+        # Never queue behind user requests for the API quota
+        if budget <= 0 or weather_budget.tokens() < 1:
+            break
+        cached = weather_cache.peek(key)
+        if cached is not None and (cached[1] is None or cached[0] > REFRESH_AHEAD):
+            continue  # Unknown city, or still fresh enough
+        budget -= 1
+        try:
+            await weather_flights.do(key, lambda: fetch_city_weather(key))
+        except UPSTREAM_ERRORS as e:
+            print(f'Refreshing the weather for {key} failed: {e!r}')
+
+def format_weather(city: str, data):
+    if isinstance(data, RateLimitedError):
+        return 'Sorry, there are too many weather requests right now. Please try again in a minute.'
+    if isinstance(data, Exception):
+        return 'Sorry, the weather service is not responding right now.'
+    if data is not None:
+        weather = data['weather'][0]['description']
+        temp = data['main']['temp']
+        return f'The weather in {city} is {weather} with a temperature of {temp}'
+    else:
+        return 'Sorry, couldn\'t find the weather for that city.'
+
 async def get_weather(city: str):
-    url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={API_KEY}&units=metric"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                weather = data['weather'][0]['description']
-                temp = data['main']['temp']
-                return f'The weather in {city} is {weather} with a temperature of {temp}'
-            else:
-                return 'Sorry, couldn\'t find the weather for that city.'
+    try:
+        data = await lookup_weather(city)
+    except UPSTREAM_ERRORS as e:
+        data = e
+    report = format_weather(city, data)
+    if data is None and city_index is not None:
+        # Comparing against every similar name is slow on a big index, keep it off the event loop
+        suggestions = await asyncio.get_running_loop().run_in_executor(None, city_index.suggest, city)
+        if suggestions:
+            report += f' Did you mean: {", ".join(name.title() for name in suggestions)}?'
+    return report
+
+async def get_weather_many(cities: list):
+    '''Builds one combined reply for several cities. Cities that fail don't stop the others.'''
+    results = await lookup_weather_many(cities)
+    lines = []
+    # One line per city, however it was spelled; the first spelling is the one shown
+    spellings = {}
+    for city in cities:
+        spellings.setdefault(normalize_city(city), city)
+    for key, city in spellings.items():
+        data = results[key]
+        line = format_weather(city, data)
+        if data is None or isinstance(data, Exception):
+            line = f'{city}: {line}'
+        lines.append(line)
+    return '\n'.join(lines)
     
 async def weather_command(update: Update, context: CallbackContext):
     '''Provides weather updates for city of choice. \n
-To use, type /weather {city_name}.'''
+To use, type /weather {city_name}, or /weather {city_1}, {city_2}, ... for several cities at once.'''
     if context.args:
         city = ' '.join(context.args)
-        weather_report = await get_weather(city)
+        if ',' in city:
+            cities = [name.strip() for name in city.split(',') if name.strip()]
+            if len(cities) > MAX_CITIES_PER_COMMAND:
+                await update.message.reply_text(f'Please ask for at most {MAX_CITIES_PER_COMMAND} cities at a time.')
+                return
+            weather_report = await get_weather_many(cities)
+        else:
+            weather_report = await get_weather(city)
         await update.message.reply_text(weather_report)
     else:
         await update.message.reply_text("Please provide a city name after the /weather command.")
@@ -110,52 +293,169 @@ async def reminder_callback(context: CallbackContext):
 
 async def facts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     '''This function generates random facts. \n 
-    To use, type /fact'''
-    with open('facts.txt', 'r') as fact_file:
-        facts_list = fact_file.readlines()
-        facts_list = re.sub(r'[ ,]*$', '', facts_list)
-    fact = random.choice(facts_list)
-    await update.message.reply_text(fact)
+    To use, type /fact, or /fact {topic} for a fact about a topic (e.g. /fact space, /fact animals),
+    or /fact search {words} for the facts that best match your words.'''
+    facts, topic_index, search_index = fact_store.snapshot()
+    if not len(facts):
+        await update.message.reply_text('Sorry, I have no facts to share right now.')
+        return
+    if context.args and search_index is None:
+        # Corpus packs are too big to index in memory
+        await update.message.reply_text('Topics and search aren\'t available for this fact pack, try plain /fact.')
+        return
+    if context.args and context.args[0].lower() == 'search':
+        query = ' '.join(context.args[1:])
+        results = search_index.search(query, limit=3)
+        if not results:
+            await update.message.reply_text('No facts match your search.' if query else 'Please type some words after /fact search.')
+            return
+        await update.message.reply_text('\n'.join(f'{num}. {facts[fact_id]}' for num, (_, fact_id) in enumerate(results, 1)))
+        return
+    if context.args:
+        index = topic_index.random_match(context.args)
+        if index is None:
+            await update.message.reply_text(f'I don\'t know any facts about {" ".join(context.args)}. '
+                                            f'Try one of these topics: {", ".join(topic_index.topics())}.')
+            return
+        await update.message.reply_text(facts[index])
+        return
+    # Each chat walks its own shuffled order of the facts, stored as a (seed, cursor, size) tuple
+    index, context.chat_data['fact_order'] = next_fact_index(context.chat_data.get('fact_order'), len(facts))
+    await update.message.reply_text(facts[index])
+
+async def reload_facts(context: CallbackContext):
+    '''Job that picks up changes to the facts file without restarting the bot.
+    Loading and indexing run in a worker thread so big packs don't block the bot.'''
+    try:
+        if await asyncio.get_running_loop().run_in_executor(None, fact_store.reload):
+            print(f'Loaded {len(fact_store)} facts from {fact_store.path}')
+            for cluster in fact_store.duplicates:
+                print(f'Collapsed {len(cluster) - 1} near-duplicate(s) of "{cluster[0]}"')
+    except OSError as e:
+        print(f'Could not reload the facts: {e}')
 
 
 
 async def calculator_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     '''This function is used to evaluate mathematical expressions. \n
-    To use, type /calculator {expression}'''
+    To use, type /calculator {expression}. Supports + - * / % ^ ! and brackets.
+    Start with "exact" for fractions, or "prec=50" for 50 significant digits.
+    For a table of values, type /calculator table x^2+3x for x in 0..10 step 0.5
+    Set variables with /calculator a = 3.5 and use them, or ans for the last result, in later expressions.
+    End with "in" and a unit to convert, like /calculator 5 mi + 3 km in m'''
+    expression = ' '.join(context.args)
     try:
-        expression = ''.join(context.args)
-        # Validate the expression to contain only numbers and operators
-        if not all(char.isdigit() or char in '+-*/.() ' for char in expression):
-            await update.message.reply_text('Please use only numbers and operators (+, -, *, /, ., (, )).')
+        if is_table(expression):
+            summary, document = await calculate_table(expression)
+            await update.message.reply_text(summary)
+            if document:
+                await update.message.reply_document(document=document, filename='table.csv')
             return
-        
-        # Evaluate the expression safely
-        result = eval(expression, {"__builtins__": None}, {})
+        # The expression is checked against a whitelist and compiled, never passed to eval as text.
+        # Expensive ones run in a separate process so they can't freeze the bot.
+        result = await calculate(expression, variable_scopes.get(update.effective_chat.id))
         await update.message.reply_text(f'The result is: {result}')
-    except Exception as e:
+    except CalculatorError as e:
+        await update.message.reply_text(str(e))
+    except (ArithmeticError, ValueError) as e:
+        await update.message.reply_text(f'Error: {str(e)}')
+
+
+async def convert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    '''This function is used to convert between units. 
+
+    To use, type /convert {value} {unit} {new unit}, like /convert 5 miles km or /convert 70 F C.
+    The value can be an expression, like /convert 2*3.5 kg lb'''
+    args = list(context.args)
+    if len(args) >= 4 and args[-2].lower() in ('in', 'to'):
+        del args[-2]  # /convert 5 miles to km
+    if len(args) < 3:
+        await update.message.reply_text('Please use the format: /convert 5 miles km')
+        return
+    *value, unit, new_unit = args
+    try:
+        # The calculator does the conversion, so the value can use variables and every mode
+        result = await calculate(f'{" ".join(value)} {unit} in {new_unit}', variable_scopes.get(update.effective_chat.id))
+        await update.message.reply_text(f'{" ".join(value)} {unit} = {result}')
+    except CalculatorError as e:
+        await update.message.reply_text(str(e))
+    except (ArithmeticError, ValueError) as e:
         await update.message.reply_text(f'Error: {str(e)}')
        
 
 
-task_list = []
 async def tasks_command (update: Update, context: ContextTypes.DEFAULT_TYPE):
     '''This function is used to manage tasks. \n    
-    To use, type /tasks {task} to add a task or /tasks list to list all tasks or /tasks done {task_number} to mark a task as done.'''
+    To use, type /tasks {task} to add a task, put one task per line to add several at once,
+    type /tasks list to list all tasks or /done {task_number} to mark a task as done.'''
     string = ' '.join(context.args)
+    # Every chat has its own task list
+    chat_id = update.effective_chat.id
     if string == 'list':
-        num = 1
-        for task in task_list:
-            await update.message.reply_text(f'{num} {task} \n')
-            num += 1
+        # The whole list goes out as one message, longer lists get buttons to page through it
+        text, keyboard = tasks_page(chat_id, 0)
+        await update.message.reply_text(text, reply_markup=keyboard)
     else:
-        task_list.append(string)
-        await update.message.reply_text(f'You have added the task: {string}')
+        # context.args loses the line breaks, so the tasks come from the message text
+        parts = update.message.text.split(maxsplit=1)
+        lines = [' '.join(line.split()) for line in parts[1].splitlines()] if len(parts) > 1 else []
+        try:
+            # All the tasks of one message are saved in one go
+            numbers = task_store.add_many(chat_id, lines)
+        except TaskError as e:
+            await update.message.reply_text(str(e))
+            return
+        if len(numbers) == 1:
+            await update.message.reply_text(f'You have added task {numbers[0]}: {task_store.task(chat_id, numbers[0]).text}')
+        else:
+            await update.message.reply_text(f'You have added {len(numbers)} tasks, numbered {numbers[0]} to {numbers[-1]}.')
+
+def tasks_page(chat_id, page):
+    '''Returns the text and keyboard of one page of a chat's task list.
+    The buttons only carry the page number, the page itself is rendered again from the store.'''
+    pages = task_pages(task_store.tasks(chat_id))
+    if not pages:
+        return 'You have no tasks. Add one with /tasks {task}', None
+    # Tasks may have changed since the buttons were sent
+    page = min(page, len(pages) - 1)
+    if len(pages) == 1:
+        return pages[0], None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton('‹ Prev', callback_data=f'tasks:{page - 1}'))
+    buttons.append(InlineKeyboardButton(f'{page + 1}/{len(pages)}', callback_data=f'tasks:{page}'))
+    if page < len(pages) - 1:
+        buttons.append(InlineKeyboardButton('Next ›', callback_data=f'tasks:{page + 1}'))
+    return pages[page], InlineKeyboardMarkup([buttons])
+
+async def tasks_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    '''Turns the page of a /tasks list when one of its buttons is pressed.'''
+    query = update.callback_query
+    await query.answer()
+    text, keyboard = tasks_page(update.effective_chat.id, int(query.data.split(':')[1]))
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except BadRequest as e:
+        # Pressing the button of the page already shown changes nothing
+        if 'not modified' not in str(e):
+            raise
 
 async def done_command(update : Update, context : ContextTypes.DEFAULT_TYPE):
-    task_number = int(context.args[0]) - 1
-    if 0 <= task_number < len(task_list):
-        removed_task = task_list.pop(task_number)
-        await update.message.reply_text(f'Task "{removed_task}" marked as done and removed from the list.')
+    '''This function is used to mark tasks as done. \n
+    To use, type /done {task_number}, with the number shown by /tasks list. Several numbers and
+    ranges mark several tasks at once, like /done 1 3 5-9'''
+    try:
+        ranges = parse_numbers(context.args)
+    except TaskError as e:
+        await update.message.reply_text(str(e))
+        return
+    # All the tasks are removed in one go
+    done = task_store.complete_many(update.effective_chat.id, ranges)
+    if len(done) == 1:
+        await update.message.reply_text(f'Task "{done[0].text}" marked as done and removed from the list.')
+    elif done:
+        numbers = ', '.join(str(task.position) for task in done)
+        await update.message.reply_text(f'Marked {len(done)} tasks as done and removed them from the list: {numbers}')
     else:
         await update.message.reply_text('Invalid task number. Please provide a valid task number.')
 
@@ -202,10 +502,42 @@ async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+async def post_init(application: Application):
+    global city_index
+    # Shared HTTP connection pool for the weather lookups
+    await http_sessions.start()
+    city_index = load_city_index(CITY_INDEX)
+    if city_index is None:
+        print(f'No city index found at {CITY_INDEX}, weather lookups will search by name')
+    await reload_facts(None)
+    # Saved tasks are loaded once, after that the writer thread keeps the database up to date
+    loaded = await asyncio.get_running_loop().run_in_executor(None, task_store.open, TASKS_DB)
+    print(f'Loaded {loaded} tasks from {TASKS_DB}')
+    # The job queue is stopped together with the application, which ends these jobs too
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(refresh_popular_weather, interval=REFRESH_INTERVAL,
+                                            first=REFRESH_INTERVAL, name='weather-refresh')
+        application.job_queue.run_repeating(reload_facts, interval=FACTS_RELOAD_INTERVAL,
+                                            first=FACTS_RELOAD_INTERVAL, name='facts-reload')
+    else:
+        print('Job queue is not available, popular cities will not be refreshed and facts.txt will not be reloaded')
+
+async def post_shutdown(application: Application):
+    await http_sessions.close()
+    if city_index is not None:
+        city_index.close()
+    # Waits for the task changes still queued to be committed
+    await asyncio.get_running_loop().run_in_executor(None, task_store.close)
+
+
 def main():
     print('Starting bot...') 
 
-    application = Application.builder().token(TOKEN).build()
+    # Chat data (like each chat's place in the facts) is kept across restarts
+    persistence = PicklePersistence(filepath=PERSISTENCE_FILE,
+                                    store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=False, callback_data=False))
+    application = (Application.builder().token(TOKEN).persistence(persistence)
+                   .post_init(post_init).post_shutdown(post_shutdown).build())
     #Commands
     application.add_handler(CommandHandler('start', start_command))
 
@@ -219,7 +551,10 @@ def main():
 
     application.add_handler(CommandHandler('calculator', calculator_command))
 
+    application.add_handler(CommandHandler('convert', convert_command))
+
     application.add_handler(CommandHandler('tasks', tasks_command))
+    application.add_handler(CallbackQueryHandler(tasks_page_callback, pattern=r'^tasks:\d+$'))
 
     application.add_handler(CommandHandler('done', done_command))
 
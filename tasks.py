@@ -0,0 +1,299 @@
+'''Task lists used by the /tasks and /done commands.
+
+Every chat has its own list, found by chat id in a dict, so one chat never sees
+or completes another chat's tasks. A task keeps the number it was given when it
+was added until it is done, and numbers are never reused within a chat, so a
+/done can't hit a different task than the one that was listed. Store methods never await, so under asyncio
+each one runs as a single step even when updates from many chats are handled
+concurrently.
+
+The lists are kept durable in a SQLite database in WAL mode. Reads are served
+from memory; every change is also queued for a dedicated writer thread, which
+commits whatever has queued up as one transaction. Commands never wait for the
+disk, and a burst of changes costs one commit instead of one per change.'''
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+MAX_TASKS_PER_CHAT = int(os.getenv('TASKS_MAX_PER_CHAT', 100))
+MAX_TASK_LENGTH = int(os.getenv('TASKS_MAX_LENGTH', 500))
+TASKS_DB = os.getenv('TASKS_DB', 'tasks.sqlite3')
+# Most changes the writer thread commits in one transaction
+WRITE_BATCH_SIZE = int(os.getenv('TASKS_WRITE_BATCH_SIZE', 1000))
+# Telegram's limit on the text of one message
+MAX_MESSAGE_LENGTH = 4096
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    chat_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    added REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS tasks_chat_position ON tasks (chat_id, position);
+CREATE TABLE IF NOT EXISTS task_counters (
+    chat_id INTEGER PRIMARY KEY,
+    next_position INTEGER NOT NULL
+);
+'''
+INSERT_TASK = 'INSERT INTO tasks (chat_id, position, text, added) VALUES (?, ?, ?, ?)'
+DELETE_TASK = 'DELETE FROM tasks WHERE chat_id = ? AND position = ?'
+# max() makes the counter only go up, whatever order the writer applies them in
+SAVE_COUNTER = '''INSERT INTO task_counters (chat_id, next_position) VALUES (?, ?)
+ON CONFLICT (chat_id) DO UPDATE SET next_position = max(next_position, excluded.next_position)'''
+
+
+class TaskError(ValueError):
+    '''Raised for tasks the store refuses, with a message meant for the user.'''
+
+
+class Task:
+    '''One task. Slots keep the per-task overhead to its three fields.
+    position is the task's number in its chat, which orders the chat's tasks
+    and is the task's key in the database.'''
+    __slots__ = ('position', 'text', 'added')
+
+    def __init__(self, position, text, added=None):
+        self.position = position
+        self.text = text
+        self.added = time.time() if added is None else added
+
+    def __repr__(self):
+        return f'Task({self.text!r})'
+
+
+def connect(path):
+    connection = sqlite3.connect(path)
+    # WAL lets the database be read while the writer commits, and with WAL a
+    # commit only has to wait for the disk at checkpoints
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class TaskWriter(threading.Thread):
+    '''Write-behind queue in front of the task database.
+
+    Changes are (statement, parameters) pairs, submitted in lists that always
+    commit together. The thread takes the first list waiting, drains whatever
+    else has queued up behind it, and commits them all in one transaction.'''
+
+    _STOP = object()
+
+    def __init__(self, path, batch_size=WRITE_BATCH_SIZE):
+        super().__init__(name='task-writer', daemon=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.commits = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+
+    def submit(self, changes):
+        self._queue.put(changes)
+
+    def flush(self):
+        '''Blocks until every change submitted so far is committed.'''
+        self._queue.join()
+
+    def close(self):
+        '''Commits what is left and stops the thread.'''
+        self._queue.put(self._STOP)
+        self.join()
+
+    def run(self):
+        connection = connect(self.path)
+        try:
+            stopping = False
+            while not stopping:
+                submitted = [self._queue.get()]
+                batch = [] if submitted[0] is self._STOP else list(submitted[0])
+                while len(batch) < self.batch_size and submitted[-1] is not self._STOP:
+                    try:
+                        submitted.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                    if submitted[-1] is not self._STOP:
+                        batch.extend(submitted[-1])
+                stopping = submitted[-1] is self._STOP
+                self._commit(connection, batch)
+                for _ in submitted:
+                    self._queue.task_done()
+        finally:
+            connection.close()
+
+    def _commit(self, connection, batch):
+        if not batch:
+            return
+        try:
+            with connection:
+                # Runs of the same statement go to executemany together
+                start = 0
+                for end in range(1, len(batch) + 1):
+                    if end == len(batch) or batch[end][0] != batch[start][0]:
+                        connection.executemany(batch[start][0], [parameters for _, parameters in batch[start:end]])
+                        start = end
+            self.commits += 1
+            self.writes += len(batch)
+        except sqlite3.Error as e:
+            print(f'Could not save {len(batch)} task changes: {e}')
+
+
+class TaskStore:
+    '''Task lists of every chat, keyed by chat id. A chat without tasks only keeps
+    the next number to hand out.
+
+    Until open() is called the store only lives in memory.'''
+
+    def __init__(self, max_tasks=MAX_TASKS_PER_CHAT, max_length=MAX_TASK_LENGTH):
+        self.max_tasks = max_tasks
+        self.max_length = max_length
+        self.writer = None
+        self._chats = {}  # chat id -> {position: Task}, in the order they were added
+        self._next_positions = {}  # chat id -> number of the chat's next task
+
+    def __len__(self):
+        return len(self._chats)
+
+    def open(self, path=TASKS_DB):
+        '''Loads the tasks saved in the database at path and saves every change from now on.
+        Blocks while loading, so call it from an executor.'''
+        connection = connect(path)
+        try:
+            chats = {}
+            for chat_id, position, text, added in connection.execute(
+                    'SELECT chat_id, position, text, added FROM tasks ORDER BY chat_id, position'):
+                chats.setdefault(chat_id, {})[position] = Task(position, text, added)
+            next_positions = dict(connection.execute('SELECT chat_id, next_position FROM task_counters'))
+        finally:
+            connection.close()
+        for chat_id, tasks in chats.items():
+            next_positions[chat_id] = max(next_positions.get(chat_id, 1), next(reversed(tasks)) + 1)
+        self._chats = chats
+        self._next_positions = next_positions
+        self.writer = TaskWriter(path)
+        self.writer.start()
+        return sum(map(len, chats.values()))
+
+    def close(self):
+        '''Saves the changes still queued and stops writing them. Blocks, so call it from an executor.'''
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def _save(self, changes):
+        '''Queues the changes of one command, which are committed together.'''
+        if self.writer is not None and changes:
+            self.writer.submit(changes)
+
+    def tasks(self, chat_id):
+        '''Returns the chat's tasks in the order they were added.'''
+        return tuple(self._chats.get(chat_id, {}).values())
+
+    def task(self, chat_id, number):
+        '''Returns the chat's task with this number, or None.'''
+        return self._chats.get(chat_id, {}).get(number)
+
+    def add(self, chat_id, text):
+        '''Adds a task and returns its number.'''
+        return self.add_many(chat_id, [text])[0]
+
+    def add_many(self, chat_id, texts):
+        '''Adds tasks in order and returns their numbers. Either all of them are added or,
+        with a TaskError, none.'''
+        texts = [text.strip() for text in texts]
+        texts = [text for text in texts if text]
+        if not texts:
+            raise TaskError('Please type the task after /tasks, like /tasks buy groceries')
+        if any(len(text) > self.max_length for text in texts):
+            raise TaskError(f'Tasks can be at most {self.max_length} characters long.')
+        tasks = self._chats.get(chat_id, {})
+        if len(tasks) + len(texts) > self.max_tasks:
+            raise TaskError(f'You can have at most {self.max_tasks} tasks, mark some as done first.')
+        first = self._next_positions.get(chat_id, 1)
+        added = time.time()
+        changes = []
+        for position, text in enumerate(texts, first):
+            tasks[position] = Task(position, text, added)
+            changes.append((INSERT_TASK, (chat_id, position, text, added)))
+        self._chats[chat_id] = tasks
+        self._next_positions[chat_id] = first + len(texts)
+        self._save(changes)
+        return list(range(first, first + len(texts)))
+
+    def complete(self, chat_id, number):
+        '''Removes the task with this number and returns it, or None if there is no such task.'''
+        done = self.complete_many(chat_id, [(number, number)])
+        return done[0] if done else None
+
+    def complete_many(self, chat_id, ranges):
+        '''Removes the tasks with numbers in any of the inclusive (first, last) ranges and
+        returns them in order. Numbers without a task are skipped.'''
+        tasks = self._chats.get(chat_id)
+        if not tasks:
+            return []
+        numbers = set()
+        for first, last in ranges:
+            # A range wider than the list is checked against the list instead of number by number
+            if last - first < len(tasks):
+                numbers.update(number for number in range(first, last + 1) if number in tasks)
+            else:
+                numbers.update(number for number in tasks if first <= number <= last)
+        # While the highest number is still in the table, open() can tell the next number from it
+        highest = next(reversed(tasks))
+        done = [tasks.pop(number) for number in sorted(numbers)]
+        changes = [(DELETE_TASK, (chat_id, task.position)) for task in done]
+        if highest in numbers:
+            changes.append((SAVE_COUNTER, (chat_id, self._next_positions[chat_id])))
+        self._save(changes)
+        if not tasks:
+            del self._chats[chat_id]
+        return done
+
+
+def parse_numbers(args):
+    '''Parses task numbers and ranges like ['1', '3', '5-9'] or ['1,3,5-9'] into
+    inclusive (first, last) ranges.'''
+    ranges = []
+    for part in ','.join(args).split(','):
+        if not part:
+            continue
+        first, dash, last = part.partition('-')
+        if not first.isdecimal() or dash and not last.isdecimal():
+            raise TaskError(f'"{part}" is not a task number or a range like 5-9')
+        first, last = int(first), int(last or first)
+        if first > last:
+            raise TaskError(f'The range {part} runs backwards, try {last}-{first}')
+        ranges.append((first, last))
+    if not ranges:
+        raise TaskError('Please provide a task number, like /done 1 or /done 1 3 5-9')
+    return ranges
+
+
+def task_pages(tasks, limit=MAX_MESSAGE_LENGTH):
+    '''Renders tasks with their numbers into as few messages as possible, each at most limit characters.
+    A page only ends between tasks unless a single task is longer than a whole page.'''
+    pages, lines, length = [], [], 0
+    for task in tasks:
+        line = f'{task.position}. {task.text}'
+        while len(line) > limit:
+            if lines:
+                pages.append('\n'.join(lines))
+                lines, length = [], 0
+            pages.append(line[:limit])
+            line = line[limit:]
+        # +1 for the newline in front of every line but the first
+        if lines and length + 1 + len(line) > limit:
+            pages.append('\n'.join(lines))
+            lines, length = [], 0
+        length += len(line) + bool(lines)
+        lines.append(line)
+    if lines:
+        pages.append('\n'.join(lines))
+    return pages
+
+
+task_store = TaskStore()
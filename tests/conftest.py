@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules live next to src.py, not in a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+from cities import CityIndex, build_city_index, load_city_index
+
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ra', 'to', 'su', 'vi', 'ber', 'dan', 'gor', 'lin', 'port', 'stad', 'ville', 'burg']
+# Cities whose names start with a multi-byte letter, and one in another script
+SPECIAL = [('Örebro', 900001), ('Øster Hurup', 900002), ('Über', 900003), ('Ürümqi', 900004),
+           ('Москва', 900005), ('Île-de-Batz', 900006)]
+
+
+def generated_cities(count=3000, seed=7):
+    '''count made-up (name, id) pairs in source order, the same every run.'''
+    rng = random.Random(seed)
+    return [(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).title(), 100000 + i)
+            for i in range(count)]
+
+
+@pytest.fixture(scope='module')
+def cities():
+    return generated_cities() + SPECIAL + [('London', 2643743), ('London', 6058560), ('  LONDON ', 1)]
+
+
+@pytest.fixture(scope='module')
+def index(cities, tmp_path_factory):
+    path = tmp_path_factory.mktemp('cities') / 'cities.idx'
+    build_city_index(cities, path)
+    city_index = CityIndex(path)
+    yield city_index
+    city_index.close()
+
+
+def test_every_name_is_found_with_its_first_id(index, cities):
+    first_ids = {}
+    for name, city_id in cities:
+        first_ids.setdefault(' '.join(name.split()).casefold(), city_id)
+    assert len(index) == len(first_ids)
+    for name, city_id in first_ids.items():
+        assert index.lookup(name) == city_id
+
+
+def test_duplicate_names_keep_the_first_id(index):
+    assert index.lookup('London') == 2643743
+    assert index.lookup('  london') == 2643743
+
+
+def test_unknown_and_empty_names(index):
+    assert index.lookup('Atlantis') is None
+    assert index.lookup('') is None
+    assert index.lookup('   ') is None
+    assert index.prefix('zzzz') == []
+    assert index.suggest('') == []
+    assert index.suggest('   ') == []
+
+
+def test_multi_byte_first_letters(index):
+    assert index.lookup('örebro') == 900001
+    assert index.lookup('MOSKVA') is None
+    assert index.lookup('москва') == 900005
+    assert [name for name, _ in index.prefix('ü')] == ['über', 'ürümqi']
+    assert index.prefix('Øster') == [('øster hurup', 900002)]
+    assert index.suggest('Orebro') == []  # A different first letter is never compared
+    assert index.suggest('Örebo') == ['örebro']
+    assert index.suggest('Москв') == ['москва']
+
+
+def test_prefix_is_sorted_and_limited(index, cities):
+    names = sorted({' '.join(name.split()).casefold() for name, _ in cities if name.lower().startswith('ka')})
+    found = index.prefix('Ka', limit=len(names) + 10)
+    assert [name for name, _ in found] == names
+    assert all(index.lookup(name) == city_id for name, city_id in found)
+    assert len(index.prefix('ka', limit=5)) == 5
+
+
+def test_suggest_finds_a_typo(index):
+    assert 'london' in index.suggest('Londn')
+    assert index.suggest('Londn') == index.suggest('  LONDN')  # Cached per normalized name
+    assert len(index.suggest('ka', limit=2, cutoff=0)) <= 2
+
+
+def test_bad_magic_is_refused(tmp_path):
+    path = tmp_path / 'not-an-index'
+    path.write_bytes(b'NOPE' + bytes(16))
+    with pytest.raises(ValueError):
+        CityIndex(path)
+
+
+def test_missing_index_is_not_loaded(tmp_path):
+    assert load_city_index(tmp_path / 'missing.idx') is None
+    assert load_city_index('') is None
+
+
+def test_empty_index(tmp_path):
+    path = tmp_path / 'empty.idx'
+    assert build_city_index([], path) == 0
+    city_index = CityIndex(path)
+    assert len(city_index) == 0
+    assert city_index.lookup('london') is None
+    assert city_index.prefix('l') == []
+    assert city_index.suggest('london') == []
+    city_index.close()
@@ -0,0 +1,33 @@
+import random
+
+import pytest
+
+from facts import next_fact_index, permute
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 16, 17, 100, 1000, 4097])
+def test_permute_is_a_bijection(size):
+    for seed in (0, 1, 0xDEADBEEF):
+        assert sorted(permute(i, seed, size) for i in range(size)) == list(range(size))
+
+
+def test_permute_depends_on_the_seed():
+    orders = {tuple(permute(i, seed, 50) for i in range(50)) for seed in range(5)}
+    assert len(orders) == 5
+
+
+def test_next_fact_index_shows_every_fact_once_per_round():
+    random.seed(3)
+    state, seen = None, []
+    for _ in range(30):
+        index, state = next_fact_index(state, 10)
+        seen.append(index)
+    for start in (0, 10, 20):
+        assert sorted(seen[start:start + 10]) == list(range(10))
+
+
+def test_next_fact_index_restarts_when_the_pool_changes():
+    index, state = next_fact_index(None, 10)
+    index, state = next_fact_index(state, 12)
+    assert state[1:] == (1, 12)
+    assert 0 <= index < 12
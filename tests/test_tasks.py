@@ -0,0 +1,168 @@
+import sqlite3
+
+import pytest
+
+from tasks import TaskError, TaskStore, parse_numbers
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'tasks.sqlite3')
+
+
+def reopen(store, path):
+    '''Closes store, which commits everything queued, and opens the database again.'''
+    store.close()
+    reopened = TaskStore()
+    reopened.open(path)
+    return reopened
+
+
+def texts(store, chat_id):
+    return [task.text for task in store.tasks(chat_id)]
+
+
+def test_tasks_survive_a_restart(path):
+    store = TaskStore()
+    assert store.open(path) == 0
+    store.add(1, 'buy milk')
+    store.add(1, 'call mom')
+    store.add(2, 'other chat')
+    store.complete(1, 1)
+    store = reopen(store, path)
+    assert texts(store, 1) == ['call mom']
+    assert texts(store, 2) == ['other chat']
+    store.close()
+
+
+def test_database_uses_wal(path):
+    store = TaskStore()
+    store.open(path)
+    store.close()
+    with sqlite3.connect(path) as connection:
+        assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_flush_commits_without_closing(path):
+    store = TaskStore()
+    store.open(path)
+    for i in range(50):
+        store.add(7, f'task {i}')
+    store.writer.flush()
+    with sqlite3.connect(path) as connection:
+        assert connection.execute('SELECT count(*) FROM tasks WHERE chat_id = 7').fetchone()[0] == 50
+    assert store.writer.commits <= 50
+    store.close()
+
+
+def test_without_open_the_store_only_lives_in_memory():
+    store = TaskStore()
+    store.add(1, 'in memory')
+    assert texts(store, 1) == ['in memory']
+    store.close()  # Nothing to close
+
+
+def test_refused_tasks():
+    store = TaskStore(max_tasks=2, max_length=10)
+    with pytest.raises(TaskError):
+        store.add(1, '   ')
+    with pytest.raises(TaskError):
+        store.add(1, 'x' * 11)
+    store.add(1, 'one')
+    store.add(1, 'two')
+    with pytest.raises(TaskError):
+        store.add(1, 'three')
+    assert texts(store, 1) == ['one', 'two']
+
+
+def test_numbers_stay_put_when_others_are_done():
+    store = TaskStore()
+    assert [store.add(1, text) for text in 'abcd'] == [1, 2, 3, 4]
+    assert store.complete(1, 2).text == 'b'
+    assert store.complete(1, 2) is None
+    assert [task.position for task in store.tasks(1)] == [1, 3, 4]
+    assert store.task(1, 3).text == 'c'
+    assert store.task(1, 2) is None
+    assert store.add(1, 'e') == 5
+
+
+def test_numbers_are_not_reused_after_the_list_empties():
+    store = TaskStore()
+    store.add(1, 'a')
+    store.complete(1, 1)
+    assert store.tasks(1) == ()
+    assert store.add(1, 'b') == 2
+
+
+def test_counter_is_recovered_after_a_restart(path):
+    store = TaskStore()
+    store.open(path)
+    store.add(1, 'a')
+    store.add(1, 'b')
+    store.add(1, 'c')
+    store = reopen(store, path)
+    # Recovered from the highest number still saved
+    assert store.add(1, 'd') == 4
+    store.complete(1, 4)
+    store.complete(1, 3)
+    store = reopen(store, path)
+    # The highest numbers are gone from the table, the saved counter remembers them
+    assert [task.position for task in store.tasks(1)] == [1, 2]
+    assert store.add(1, 'e') == 5
+    store.complete_many(1, [(1, 5)])
+    store = reopen(store, path)
+    assert store.tasks(1) == ()
+    assert store.add(1, 'f') == 6
+    store.close()
+
+
+@pytest.mark.parametrize('args, ranges', [
+    (['1'], [(1, 1)]),
+    (['1', '3', '5-9'], [(1, 1), (3, 3), (5, 9)]),
+    (['1,3,5-9'], [(1, 1), (3, 3), (5, 9)]),
+    (['1,', '3'], [(1, 1), (3, 3)]),
+    (['7-7'], [(7, 7)]),
+])
+def test_parse_numbers(args, ranges):
+    assert parse_numbers(args) == ranges
+
+
+@pytest.mark.parametrize('args', [[], [','], ['abc'], ['1-'], ['-3'], ['9-5'], ['1.5'], ['²'], ['1-2-3']])
+def test_parse_numbers_refuses(args):
+    with pytest.raises(TaskError):
+        parse_numbers(args)
+
+
+def test_bulk_add_is_all_or_nothing():
+    store = TaskStore(max_tasks=3, max_length=10)
+    assert store.add_many(1, ['a', '  ', 'b']) == [1, 2]
+    with pytest.raises(TaskError):
+        store.add_many(1, ['c', 'd'])
+    with pytest.raises(TaskError):
+        store.add_many(2, ['ok', 'x' * 11])
+    assert texts(store, 1) == ['a', 'b']
+    assert store.tasks(2) == ()
+
+
+def test_complete_many_skips_missing_numbers():
+    store = TaskStore()
+    store.add_many(1, [f'task {i}' for i in range(1, 11)])
+    done = store.complete_many(1, parse_numbers(['1', '3', '5-7', '42', '2-2']))
+    assert [task.position for task in done] == [1, 2, 3, 5, 6, 7]
+    assert [task.position for task in store.tasks(1)] == [4, 8, 9, 10]
+    # A huge range is checked against the list, not number by number
+    assert len(store.complete_many(1, [(1, 10 ** 12)])) == 4
+    assert store.complete_many(1, [(1, 1)]) == []
+
+
+def test_one_command_is_one_transaction(path):
+    store = TaskStore()
+    store.open(path)
+    store.writer.flush()
+    commits = store.writer.commits
+    store.add_many(1, [f'task {i}' for i in range(20)])
+    store.writer.flush()
+    store.complete_many(1, [(1, 20)])
+    store.writer.flush()
+    assert store.writer.commits - commits == 2
+    store.close()
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from calculator import CalculatorError, calculate
+
+
+def convert(text, variables=None):
+    return asyncio.run(calculate(text, variables))
+
+
+@pytest.mark.parametrize('text, result', [
+    ('5 km in m', '5000 m'),
+    ('5 mi + 3 km in km', '11.04672 km'),
+    ('-5 km in m', '-5000 m'),
+    ('2 * 5 km in m', '10000 m'),
+    ('(5 km + 3 m) * 2 in m', '10006 m'),
+    ('10 m/s in km/h', '36.0 km/h'),
+    ('-40 F in C', '-40.0 C'),
+    ('1 KM in m', '1000 m'),
+])
+def test_conversions(text, result):
+    assert convert(text) == result
+
+
+@pytest.mark.parametrize('text', [
+    '5 km + 2 in m',  # The 2 has no unit
+    '5 in km',
+    'x in km',
+    '2 * (5 km + 3) in m',
+    '6 m / 2 m in km',  # Units don't cancel out
+    '1 km * 1 km in m',
+    '(3 km)^2 in m',
+    '5 km + 70 F in C',
+    '1 mPa in Pa',  # mPa isn't defined and must not fold to MPa
+    '1 km in foo',
+])
+def test_refused_conversions(text):
+    with pytest.raises(CalculatorError):
+        convert(text, {'x': 3})
@@ -0,0 +1,281 @@
+'''Unit conversions used by /convert and the calculator.
+
+Units are defined relative to one another, which makes a graph. When the
+module is imported, every unit is resolved to its dimension's base unit. From
+that, the scale and offset between every pair of units of the same dimension
+go into one table. A conversion is then a dictionary lookup followed by
+value * scale + offset, with no path search.
+
+Scales and offsets are kept as exact fractions, plus float copies for the
+fast path.
+
+To list the known units, run: python units.py'''
+import sys
+from fractions import Fraction
+
+
+# (symbols | long names, definition, prefixes)
+# A definition is "factor unit", "factor unit + offset" (also "- offset") or "[dimension]"
+# for the base unit of a dimension. Prefixed units (km, mg, kWh...) are generated from
+# the space separated SI prefixes.
+UNITS = [
+    # Length
+    ('m | metre metres meter meters', '[length]', 'k h d c m µ n'),
+    ('in | inch inches', '2.54 cm', ''),
+    ('ft | foot feet', '12 in', ''),
+    ('yd | yard yards', '3 ft', ''),
+    ('mi | mile miles', '1760 yd', ''),
+    ('nmi | nautical-mile nautical-miles', '1852 m', ''),
+    ('au | astronomical-unit astronomical-units', '149597870700 m', ''),
+    ('ly | light-year light-years lightyear lightyears', '9460730472580800 m', ''),
+    ('pc | parsec parsecs', '30856775814913673 m', ''),
+    ('Å | angstrom angstroms', '0.1 nm', ''),
+    # Area
+    ('m2 m² | square-metre square-metres square-meter square-meters sqm', '[area]', ''),
+    ('km2 km² | square-kilometre square-kilometres square-kilometer square-kilometers', '1000000 m2', ''),
+    ('cm2 cm² | square-centimetre square-centimetres square-centimeter square-centimeters', '0.0001 m2', ''),
+    ('mm2 mm² | square-millimetre square-millimetres square-millimeter square-millimeters', '0.01 cm2', ''),
+    ('ha | hectare hectares', '10000 m2', ''),
+    ('ac | acre acres', '4046.8564224 m2', ''),
+    ('ft2 ft² | square-foot square-feet sqft', '0.09290304 m2', ''),
+    ('in2 in² | square-inch square-inches sqin', '6.4516 cm2', ''),
+    ('yd2 yd² | square-yard square-yards', '9 ft2', ''),
+    ('mi2 mi² | square-mile square-miles sqmi', '640 ac', ''),
+    # Volume
+    ('L l | litre litres liter liters', '[volume]', 'k h d c m µ'),
+    ('m3 m³ | cubic-metre cubic-metres cubic-meter cubic-meters', '1000 L', ''),
+    ('cm3 cm³ cc | cubic-centimetre cubic-centimetres cubic-centimeter cubic-centimeters', '1 mL', ''),
+    ('ft3 ft³ | cubic-foot cubic-feet', '28.316846592 L', ''),
+    ('in3 in³ | cubic-inch cubic-inches', '16.387064 cm3', ''),
+    ('gal | gallon gallons', '3.785411784 L', ''),
+    ('qt | quart quarts', '1/4 gal', ''),
+    ('pt | pint pints', '1/2 qt', ''),
+    ('cup | cups', '1/2 pt', ''),
+    ('floz | fluid-ounce fluid-ounces', '1/8 cup', ''),
+    ('tbsp | tablespoon tablespoons', '1/2 floz', ''),
+    ('tsp | teaspoon teaspoons', '1/3 tbsp', ''),
+    ('impgal | imperial-gallon imperial-gallons', '4.54609 L', ''),
+    ('imppt | imperial-pint imperial-pints', '1/8 impgal', ''),
+    ('bbl | barrel barrels', '42 gal', ''),
+    # Mass
+    ('g | gram grams gramme grammes', '[mass]', 'k h d c m µ n'),
+    ('t | tonne tonnes metric-ton metric-tons', '1000 kg', ''),
+    ('lb lbs | pound pounds', '453.59237 g', ''),
+    ('oz | ounce ounces', '1/16 lb', ''),
+    ('st | stone stones', '14 lb', ''),
+    ('ton | tons short-ton short-tons', '2000 lb', ''),
+    ('long-ton | long-tons', '2240 lb', ''),
+    ('ct | carat carats', '0.2 g', ''),
+    ('gr | grain grains', '64.79891 mg', ''),
+    ('Da | dalton daltons', '1.66053906660e-24 g', ''),
+    # Time
+    ('s sec | second seconds secs', '[time]', 'm µ n p'),
+    ('min | minute minutes mins', '60 s', ''),
+    ('h hr | hour hours hrs', '60 min', ''),
+    ('d | day days', '24 h', ''),
+    ('wk | week weeks', '7 d', ''),
+    ('fortnight | fortnights', '14 d', ''),
+    ('yr | year years', '365.25 d', ''),
+    ('mo | month months', '1/12 yr', ''),
+    ('decade | decades', '10 yr', ''),
+    ('century | centuries', '100 yr', ''),
+    # Speed
+    ('m/s | metre-per-second metres-per-second meter-per-second meters-per-second mps', '[speed]', ''),
+    ('km/h kmh kph | kilometre-per-hour kilometres-per-hour kilometer-per-hour kilometers-per-hour', '1000/3600 m/s', ''),
+    ('mph | mile-per-hour miles-per-hour', '0.44704 m/s', ''),
+    ('kn kt | knot knots', '1852/3600 m/s', ''),
+    ('ft/s fps | foot-per-second feet-per-second', '0.3048 m/s', ''),
+    ('c | speed-of-light', '299792458 m/s', ''),
+    # Temperature
+    ('K | kelvin kelvins', '[temperature]', ''),
+    ('C °C degC | celsius centigrade', '1 K + 273.15', ''),
+    ('F °F degF | fahrenheit', '5/9 C - 160/9', ''),
+    ('R °R degR | rankine', '5/9 K', ''),
+    # Data
+    ('B | byte bytes', '[data]', 'k M G T P'),
+    ('bit | bits', '1/8 B', ''),
+    ('KiB | kibibyte kibibytes', '1024 B', ''),
+    ('MiB | mebibyte mebibytes', '1024 KiB', ''),
+    ('GiB | gibibyte gibibytes', '1024 MiB', ''),
+    ('TiB | tebibyte tebibytes', '1024 GiB', ''),
+    # Energy
+    ('J | joule joules', '[energy]', 'k M G'),
+    ('cal | calorie calories', '4.184 J', ''),
+    ('kcal Cal | kilocalorie kilocalories', '1000 cal', ''),
+    ('Wh | watt-hour watt-hours', '3600 J', 'k M G'),
+    ('eV | electronvolt electronvolts', '1.602176634e-19 J', ''),
+    ('BTU btu | british-thermal-unit british-thermal-units', '1055.05585262 J', ''),
+    # Power
+    ('W | watt watts', '[power]', 'm k M G'),
+    ('hp | horsepower', '745.69987158227022 W', ''),
+    # Pressure
+    ('Pa | pascal pascals', '[pressure]', 'h k M'),
+    ('bar | bars', '100000 Pa', 'm'),
+    ('atm | atmosphere atmospheres', '101325 Pa', ''),
+    ('psi', '6894.757293168 Pa', ''),
+    ('mmHg', '133.322387415 Pa', ''),
+    ('torr Torr', '101325/760 Pa', ''),
+    # Force
+    ('N | newton newtons', '[force]', 'k'),
+    ('lbf | pound-force', '4.4482216152605 N', ''),
+    ('kgf | kilogram-force', '9.80665 N', ''),
+    ('dyn | dyne dynes', '0.00001 N', ''),
+    # Frequency
+    ('Hz | hertz', '[frequency]', 'k M G'),
+    ('rpm', '1/60 Hz', ''),
+    # Angle
+    ('rad | radian radians', '[angle]', 'm'),
+    ('deg ° | degree degrees', '0.017453292519943295 rad', ''),
+    ('grad | gradian gradians gon', '0.9 deg', ''),
+    ('turn | turns revolution revolutions', '360 deg', ''),
+    # Electricity
+    ('V | volt volts', '[voltage]', 'm k'),
+    ('A | ampere amperes amp amps', '[current]', 'm µ'),
+]
+
+PREFIXES = {
+    'P': ('peta', 10**15), 'T': ('tera', 10**12), 'G': ('giga', 10**9), 'M': ('mega', 10**6),
+    'k': ('kilo', 10**3), 'h': ('hecto', 10**2), 'd': ('deci', Fraction(1, 10)), 'c': ('centi', Fraction(1, 100)),
+    'm': ('milli', Fraction(1, 10**3)), 'µ': ('micro', Fraction(1, 10**6)), 'n': ('nano', Fraction(1, 10**9)),
+    'p': ('pico', Fraction(1, 10**12)),
+}
+
+
+class UnitError(ValueError):
+    '''Raised for unknown units and conversions between different dimensions.'''
+
+
+class UnitTable:
+    '''Every unit pair of a dimension resolved to a direct (scale, offset).'''
+
+    def __init__(self, definitions=UNITS):
+        self.names = {}  # name or alias -> canonical symbol
+        self._folded = {}  # lowercased alias -> canonical symbol, None where that is ambiguous
+        self.definitions = {}  # canonical symbol -> definition text
+        symbols = []
+        for names, definition, prefixes in definitions:
+            symbols += self._define(names, definition, prefixes)
+        # Any prefix in front of any symbol is a possible reading of a name, even where
+        # that unit isn't defined: mPa must not fold to MPa, 10^9 times too big
+        for symbol in symbols:
+            for prefix in [*PREFIXES, 'u']:
+                self._fold(prefix + symbol, self.names.get(prefix + symbol))
+
+        # Resolve every unit to (dimension, a, b) with value in base unit = value * a + b
+        self._to_base = {}
+        for unit in self.definitions:
+            self._resolve(unit, ())
+        self.dimensions = {}
+        for unit, (dimension, _, _) in self._to_base.items():
+            self.dimensions.setdefault(dimension, []).append(unit)
+
+        # Direct conversions: exact fractions and their float copies
+        self._exact = {}
+        self._factors = {}
+        for units in self.dimensions.values():
+            for source in units:
+                _, a_source, b_source = self._to_base[source]
+                for target in units:
+                    _, a_target, b_target = self._to_base[target]
+                    scale, offset = a_source / a_target, (b_source - b_target) / a_target
+                    self._exact[source, target] = (scale, offset)
+                    self._factors[source, target] = (float(scale), float(offset))
+
+    def __len__(self):
+        return len(self.definitions)
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def _define(self, names, definition, prefixes):
+        symbols, _, long_names = names.partition('|')
+        symbols, long_names = symbols.split(), long_names.split()
+        self._add(symbols[0], symbols + long_names, definition)
+        for prefix in prefixes.split():
+            long_prefix, factor = PREFIXES[prefix]
+            prefixed = [prefix + symbol for symbol in symbols]
+            if prefix == 'µ':
+                prefixed += ['u' + symbol for symbol in symbols]
+            prefixed += [long_prefix + name for name in long_names]
+            self._add(prefixed[0], prefixed, f'{factor} {symbols[0]}')
+        return symbols
+
+    def _add(self, unit, names, definition):
+        if unit in self.definitions:
+            raise ValueError(f'Unit {unit} is defined twice')
+        self.definitions[unit] = definition
+        for name in names:
+            self.names[name] = unit
+            self._fold(name, unit)
+
+    def _fold(self, name, unit):
+        '''Records that name, when case is ignored, reads as unit (None for no known unit).'''
+        folded = name.casefold()
+        if self._folded.get(folded, unit) != unit:
+            unit = None
+        self._folded[folded] = unit
+
+    def _resolve(self, unit, seen):
+        if unit in self._to_base:
+            return self._to_base[unit]
+        if unit in seen:
+            raise ValueError(f'Unit {unit} is defined in terms of itself')
+        definition = self.definitions[unit]
+        if definition.startswith('['):
+            resolved = (definition.strip('[]'), Fraction(1), Fraction(0))
+        else:
+            factor, reference, *offset = definition.split()
+            offset = Fraction(offset[1]) * (-1 if offset[0] == '-' else 1) if offset else Fraction(0)
+            if reference not in self.names:
+                raise ValueError(f'Unit {unit} refers to the unknown unit {reference}')
+            dimension, a, b = self._resolve(self.names[reference], seen + (unit,))
+            resolved = (dimension, Fraction(factor) * a, offset * a + b)
+        self._to_base[unit] = resolved
+        return resolved
+
+    def lookup(self, name):
+        '''Returns the canonical symbol of a unit name or alias, or None if it is unknown.
+        Names match case-insensitively too, unless that would be ambiguous (mW and MW,
+        or mPa and MPa even though only MPa is defined).'''
+        unit = self.names.get(name)
+        if unit is None:
+            unit = self._folded.get(name.casefold())
+        return unit
+
+    def unit(self, name):
+        unit = self.lookup(name)
+        if unit is None:
+            raise UnitError(f'I don\'t know the unit {name}.')
+        return unit
+
+    def dimension(self, name):
+        return self._to_base[self.unit(name)][0]
+
+    def _pair(self, source, target):
+        source, target = self.unit(source), self.unit(target)
+        if (source, target) not in self._factors:
+            raise UnitError(f'Can\'t convert {self.dimension(source)} ({source}) to {self.dimension(target)} ({target}).')
+        return source, target
+
+    def factor(self, source, target):
+        '''Returns the exact (scale, offset) that turns a value in source into one in target.'''
+        return self._exact[self._pair(source, target)]
+
+    def convert(self, value, source, target):
+        '''Converts a float from one unit to another with a single multiply-add.'''
+        try:
+            scale, offset = self._factors[self.names[source], self.names[target]]
+        except KeyError:
+            scale, offset = self._factors[self._pair(source, target)]
+        return value * scale + offset
+
+
+unit_table = UnitTable()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 1:
+        sys.exit('Usage: python units.py')
+    for dimension, units in unit_table.dimensions.items():
+        print(f'{dimension}: {" ".join(units)}')
+    print(f'{len(unit_table)} units, {len(unit_table._factors)} direct conversions')
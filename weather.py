@@ -0,0 +1,459 @@
+'''Helpers used by the /weather command to talk to OpenWeatherMap.'''
+import asyncio
+import heapq
+import math
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+
+
+OWM_URL = 'http://api.openweathermap.org/data/2.5/weather'
+OWM_GROUP_URL = 'http://api.openweathermap.org/data/2.5/group'
+GROUP_MAX_IDS = 20  # Upper limit of the group endpoint
+
+# Connection pool settings, can be overridden from the .env file
+POOL_SIZE = int(os.getenv('WEATHER_POOL_SIZE', 100))
+POOL_SIZE_PER_HOST = int(os.getenv('WEATHER_POOL_SIZE_PER_HOST', 20))
+KEEPALIVE_TIMEOUT = float(os.getenv('WEATHER_KEEPALIVE_TIMEOUT', 30))
+DNS_CACHE_TTL = int(os.getenv('WEATHER_DNS_CACHE_TTL', 300))
+REQUEST_TIMEOUT = float(os.getenv('WEATHER_REQUEST_TIMEOUT', 10))
+CONNECT_TIMEOUT = float(os.getenv('WEATHER_CONNECT_TIMEOUT', 3))
+
+# Response cache settings (seconds / number of cities)
+CACHE_TTL = float(os.getenv('WEATHER_CACHE_TTL', 600))
+CACHE_NEGATIVE_TTL = float(os.getenv('WEATHER_CACHE_NEGATIVE_TTL', 3600))
+CACHE_MAX_ENTRIES = int(os.getenv('WEATHER_CACHE_MAX_ENTRIES', 1024))
+
+# Multi city lookups (/weather London, Paris, Tokyo)
+MAX_CITIES_PER_COMMAND = int(os.getenv('WEATHER_MAX_CITIES', 10))
+MULTI_CITY_CONCURRENCY = int(os.getenv('WEATHER_MULTI_CITY_CONCURRENCY', 5))
+
+# Refresh-ahead of popular cities
+REFRESH_TOP_N = int(os.getenv('WEATHER_REFRESH_TOP_N', 20))
+REFRESH_INTERVAL = float(os.getenv('WEATHER_REFRESH_INTERVAL', 60))
+REFRESH_AHEAD = float(os.getenv('WEATHER_REFRESH_AHEAD', 120))
+REFRESH_CALLS_PER_MINUTE = float(os.getenv('WEATHER_REFRESH_CALLS_PER_MINUTE', 20))
+POPULARITY_HALF_LIFE = float(os.getenv('WEATHER_POPULARITY_HALF_LIFE', 3600))
+
+# Circuit breaker around the OpenWeatherMap API
+BREAKER_FAILURES = int(os.getenv('WEATHER_BREAKER_FAILURES', 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv('WEATHER_BREAKER_RESET_TIMEOUT', 30))
+MIN_REQUEST_TIMEOUT = float(os.getenv('WEATHER_MIN_REQUEST_TIMEOUT', 1))
+
+# Quota of the API key, shared by every weather call
+CALLS_PER_MINUTE = float(os.getenv('WEATHER_CALLS_PER_MINUTE', 60))
+CALLS_BURST = float(os.getenv('WEATHER_CALLS_BURST', 10))
+QUEUE_DEADLINE = float(os.getenv('WEATHER_QUEUE_DEADLINE', 5))
+
+
+class CircuitOpenError(Exception):
+    '''Raised instead of calling the API while the circuit breaker is open.'''
+
+
+class ServerError(Exception):
+    '''Raised when the API answers with a 5xx status.'''
+
+    def __init__(self, status):
+        super().__init__(f'The weather API answered with status {status}')
+        self.status = status
+
+
+class RateLimitedError(Exception):
+    '''Raised when the API key is out of quota, either by our own budget or by a 429 answer.'''
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Everything that means "the weather service didn't give us an answer"
+UPSTREAM_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError, RateLimitedError, ServerError)
+
+
+class HttpSessionManager:
+    '''Keeps one aiohttp session alive for the lifetime of the application.
+
+    The session is opened in Application.post_init and closed in post_shutdown,
+    so every weather request reuses pooled keep-alive connections and cached DNS
+    lookups instead of doing a fresh TCP/TLS handshake.'''
+
+    def __init__(self, limit=POOL_SIZE, limit_per_host=POOL_SIZE_PER_HOST,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, dns_cache_ttl=DNS_CACHE_TTL,
+                 total_timeout=REQUEST_TIMEOUT, connect_timeout=CONNECT_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self._session = None
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def get(self):
+        '''Returns the shared session, opening it first if needed.'''
+        if self._session is None or self._session.closed:
+            return await self.start()
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+http_sessions = HttpSessionManager()
+
+
+async def fetch_weather(session, params, url=OWM_URL, timeout=None):
+    '''Makes one request to the weather endpoint.
+    Returns a (status, data) tuple, data is None when the request failed.
+    timeout is in seconds and overrides the session timeout for this call only.'''
+    kwargs = {} if timeout is None else {'timeout': aiohttp.ClientTimeout(total=timeout)}
+    async with session.get(url, params=params, **kwargs) as response:
+        if response.status == 429:
+            raise RateLimitedError('The weather API quota is used up', parse_retry_after(response.headers.get('Retry-After')))
+        if response.status == 200:
+            return response.status, await response.json()
+        return response.status, None
+
+
+def parse_retry_after(value):
+    '''Turns a Retry-After header (seconds or an HTTP date) into seconds, None if missing or invalid.'''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+async def fetch_weather_group(session, ids, params, url=OWM_GROUP_URL, timeout=None):
+    '''Fetches up to GROUP_MAX_IDS cities by their id in one request.
+    Returns a (status, data) tuple where data maps each city id to its weather.'''
+    params = dict(params, id=','.join(str(city_id) for city_id in ids))
+    status, data = await fetch_weather(session, params, url=url, timeout=timeout)
+    if data is None:
+        return status, None
+    return status, {item['id']: item for item in data.get('list', [])}
+
+
+# Normalized city name -> OpenWeatherMap city id, learned from earlier answers
+city_ids = {}
+
+
+def normalize_city(city: str):
+    '''Turns a city name into a cache key, so "  new   YORK" and "New York" are the same city.'''
+    city = unicodedata.normalize('NFKC', city)
+    return re.sub(r'\s+', ' ', city).strip().casefold()
+
+
+class WeatherCache:
+    '''Time limited LRU cache for weather responses.
+
+    Unknown cities are cached as None (negative caching) with their own TTL,
+    so repeated typos don't hit the API either.'''
+
+    MISS = object()
+
+    def __init__(self, ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL, max_entries=CACHE_MAX_ENTRIES, clock=time.monotonic):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Returns the cached value for key or WeatherCache.MISS.'''
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= self.clock():
+            self.misses += 1
+            return self.MISS
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key):
+        '''Returns (seconds left, value) for key without counting a hit, or None if it isn't cached.
+        Seconds left is negative once the entry has expired.'''
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry[0] - self.clock(), entry[1]
+
+    def set(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self._entries[key] = (self.clock() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+
+weather_cache = WeatherCache()
+
+
+class SingleFlight:
+    '''Collapses concurrent calls for the same key into one upstream request.
+
+    The first caller starts the work as a task, everyone else who asks for the same
+    key while it is running awaits that task and gets the same result or exception.'''
+
+    def __init__(self):
+        self._tasks = {}
+        self._waiters = {}
+
+    async def do(self, key, func):
+        '''Runs func() for key unless a call for key is already in flight.'''
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # Shielded so one impatient caller being cancelled doesn't cancel it for everybody
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def _finished(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # Mark as retrieved in case every caller went away
+
+    def in_flight(self):
+        return len(self._tasks)
+
+    def waiters(self):
+        '''Returns the number of callers waiting on each in-flight key.'''
+        return dict(self._waiters)
+
+
+weather_flights = SingleFlight()
+
+
+class DecayingCounter:
+    '''Counts how often each key is requested, with older requests fading out.
+
+    A score halves every half_life seconds, so the top keys follow what is
+    popular right now rather than what was popular last week.'''
+
+    def __init__(self, half_life=POPULARITY_HALF_LIFE, max_keys=10000, clock=time.monotonic):
+        self.half_life = half_life
+        self.max_keys = max_keys
+        self.clock = clock
+        self._scores = {}  # key -> (score, time of last update)
+
+    def __len__(self):
+        return len(self._scores)
+
+    def _decayed(self, score, updated, now):
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def hit(self, key, amount=1.0):
+        now = self.clock()
+        score, updated = self._scores.get(key, (0.0, now))
+        self._scores[key] = (self._decayed(score, updated, now) + amount, now)
+        if len(self._scores) > self.max_keys:
+            # Forget the least popular half instead of growing forever
+            for old_key, _ in self.top(len(self._scores))[self.max_keys // 2:]:
+                del self._scores[old_key]
+
+    def score(self, key):
+        if key not in self._scores:
+            return 0.0
+        return self._decayed(*self._scores[key], self.clock())
+
+    def top(self, n):
+        '''Returns the n most popular (key, score) pairs, most popular first.'''
+        now = self.clock()
+        scores = ((key, self._decayed(score, updated, now)) for key, (score, updated) in self._scores.items())
+        return heapq.nlargest(n, scores, key=lambda item: item[1])
+
+
+city_popularity = DecayingCounter()
+
+
+class CircuitBreaker:
+    '''Stops calling the API for a while after it keeps failing.
+
+    closed:    calls go through, consecutive failures are counted.
+    open:      calls fail straight away with CircuitOpenError until reset_timeout has passed.
+    half-open: a single trial call is let through, its outcome closes or reopens the circuit.
+
+    Timeouts follow the observed p95 latency, so a slow API is given up on quickly
+    instead of piling up waiting coroutines and sockets.'''
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT,
+                 min_timeout=MIN_REQUEST_TIMEOUT, max_timeout=REQUEST_TIMEOUT, timeout_factor=3.0,
+                 samples=200, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_factor = timeout_factor
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._latencies = deque(maxlen=samples)
+
+    def allow(self):
+        '''Returns True if a call may go to the API now.'''
+        if self.state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self, latency):
+        self._latencies.append(latency)
+        self.failures = 0
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = self.clock()
+
+    def p95(self):
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[math.ceil(0.95 * len(latencies)) - 1]
+
+    def timeout(self):
+        '''Per request timeout in seconds, a multiple of the p95 latency.'''
+        if len(self._latencies) < 20:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, self.p95() * self.timeout_factor))
+
+    async def call(self, fetch):
+        '''Runs fetch(timeout), which returns a (status, data) tuple, through the breaker.
+        Network errors, timeouts and 5xx answers count as failures; a 5xx answer raises ServerError.'''
+        if not self.allow():
+            raise CircuitOpenError('The weather service is failing, not calling it for now')
+        trial = self.state == self.HALF_OPEN
+        start = self.clock()
+        try:
+            status, data = await fetch(self.timeout())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.record_failure()
+            raise
+        finally:
+            if trial:
+                self._trial_running = False
+        if status >= 500:
+            self.record_failure()
+            raise ServerError(status)
+        self.record_success(self.clock() - start)
+        return status, data
+
+
+weather_breaker = CircuitBreaker()
+
+
+class RateBudget:
+    '''Token bucket that keeps all weather calls within the API key's per-minute quota.
+
+    When the bucket is empty a call reserves the next token and waits for it, as long as
+    it would get it within the deadline; otherwise it fails with RateLimitedError.
+    A 429 from the API stops all calls until its Retry-After has passed.'''
+
+    def __init__(self, per_minute=CALLS_PER_MINUTE, burst=CALLS_BURST, deadline=QUEUE_DEADLINE, clock=time.monotonic):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.deadline = deadline
+        self.clock = clock
+        self.queue_depth = 0
+        self.rejected = 0
+        self.throttled = 0
+        self._tokens = burst
+        self._updated = clock()
+        self._blocked_until = 0.0
+
+    def tokens(self):
+        '''Tokens left right now, negative while calls are queued for future tokens.'''
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return self._tokens
+
+    async def acquire(self, deadline=None):
+        '''Waits until a call is allowed, or raises RateLimitedError if that takes longer than deadline seconds.'''
+        deadline = self.deadline if deadline is None else deadline
+        now = self.clock()
+        tokens = self.tokens()
+        wait = max(self._blocked_until - now, (1 - tokens) / self.rate if tokens < 1 else 0.0)
+        if wait > deadline:
+            self.rejected += 1
+            raise RateLimitedError('Too many weather requests right now', wait)
+        self._tokens -= 1
+        if wait > 0:
+            self.queue_depth += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.queue_depth -= 1
+
+    def penalize(self, retry_after=None):
+        '''Called on a 429 answer, pauses all calls for retry_after seconds (a minute if unknown).'''
+        self.throttled += 1
+        self._blocked_until = max(self._blocked_until, self.clock() + (60.0 if retry_after is None else retry_after))
+        self._tokens = min(self.tokens(), 0.0)
+
+    def stats(self):
+        return {
+            'tokens': self.tokens(),
+            'queue_depth': self.queue_depth,
+            'rejected': self.rejected,
+            'throttled': self.throttled,
+        }
+
+
+weather_budget = RateBudget()